@@ -30,7 +30,7 @@ def init(path: Path):
     """
 
     try:
-        r3.Repository.init(path)
+        r3.Repository.init(path).close()
     except FileExistsError as error:
         print(f"Error: {error}")
         sys.exit(1)
@@ -60,10 +60,10 @@ def commit(path: Path, repository_path: Path) -> None:
     /repository/jobs/4b2146f3-5594-4f05-ae13-2e053ef7bfda
     ```
     """
-    repository = r3.Repository(repository_path)
-    job = r3.Job(path)
-    job = repository.commit(job)
-    print(job.path)
+    with r3.Repository(repository_path) as repository:
+        job = r3.Job(path)
+        job = repository.commit(job)
+        print(job.path)
 
 
 @cli.command()
@@ -89,9 +89,9 @@ def checkout(job_path: Path, target_path) -> None:
     ```
     """
     job_path = job_path.resolve()
-    repository = r3.Repository(job_path.parent.parent)
-    job = r3.Job(job_path, id=job_path.name)
-    repository.checkout(job, target_path)
+    with r3.Repository(job_path.parent.parent) as repository:
+        job = r3.Job(job_path, id=job_path.name)
+        repository.checkout(job, target_path)
 
 
 @cli.command()
@@ -105,13 +105,13 @@ def remove(job_path: Path) -> None:
     job will fail.
     """
     job_path = job_path.resolve()
-    repository = r3.Repository(job_path.parent.parent)
-    job = r3.Job(job_path, id=job_path.name)
+    with r3.Repository(job_path.parent.parent) as repository:
+        job = r3.Job(job_path, id=job_path.name)
 
-    try:
-        repository.remove(job)
-    except ValueError as error:
-        print(f"Error removing job: {error}")
+        try:
+            repository.remove(job)
+        except ValueError as error:
+            print(f"Error removing job: {error}")
 
 
 @cli.command()
@@ -140,16 +140,16 @@ def remove(job_path: Path) -> None:
 )
 def find(tags: Iterable[str], latest: bool, long: bool, repository_path: Path) -> None:
     """Searches the R3 repository for jobs matching the given conditions."""
-    repository = r3.Repository(repository_path)
-    query = {"tags": {"$all": tags}}
-    for job in repository.find(query, latest):
-        if long:
-            assert job.timestamp is not None
-            datetime = job.timestamp.strftime(r"%Y-%m-%d %H:%M:%S")
-            tags = " ".join(f"#{tag}" for tag in job.metadata.get("tags", []))
-            print(f"{job.id} | {datetime} | {tags}")
-        else:
-            print(job.path)
+    with r3.Repository(repository_path) as repository:
+        query = {"tags": {"$all": tags}}
+        for job in repository.find(query, latest):
+            if long:
+                assert job.timestamp is not None
+                datetime = job.timestamp.strftime(r"%Y-%m-%d %H:%M:%S")
+                tags = " ".join(f"#{tag}" for tag in job.metadata.get("tags", []))
+                print(f"{job.id} | {datetime} | {tags}")
+            else:
+                print(job.path)
 
 
 @cli.command()
@@ -166,8 +166,8 @@ def rebuild_index(repository_path: Path):
     When job metadata is modified manually, however, the index needs to be rebuilt in
     order for the changes to take effect.
     """
-    repository = r3.Repository(repository_path)
-    repository.rebuild_index()
+    with r3.Repository(repository_path) as repository:
+        repository.rebuild_index()
 
 
 if __name__ == "__main__":
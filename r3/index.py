@@ -1,15 +1,76 @@
 """Job index for efficient searching."""
 
-import json
+import os
 import sqlite3
-from datetime import datetime
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from itertools import islice
 from pathlib import Path
-from typing import Any, Dict, List, Set
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Set, Tuple
 
+import r3.utils
 from r3.job import Job, JobDependency
 from r3.query import mongo_to_sql
 from r3.storage import Storage
 
+# Version of the index schema. Index files with a different version are rebuilt.
+SCHEMA_VERSION = 5
+
+# With write-ahead logging, commits don't require syncing a rollback journal.
+JOURNAL_MODE = "WAL"
+
+# Number of jobs that are loaded in parallel when rebuilding the index.
+REBUILD_BATCH_SIZE = 256
+
+# Number of queries that `find_many` combines into a single statement. SQLite limits
+# the number of terms in a compound SELECT to 500 by default.
+FIND_BATCH_SIZE = 256
+
+# Number of compiled SQL statements that are cached per connection.
+STATEMENT_CACHE_SIZE = 256
+
+# Number of parsed job configs that are kept in memory by each index.
+CONFIG_CACHE_SIZE = 4096
+
+# Applied to every connection to the index database.
+CONNECTION_PRAGMAS: Dict[str, Any] = {
+    "synchronous": "NORMAL",
+    "temp_store": "MEMORY",
+    "mmap_size": 1 << 30,
+    "cache_size": -65536,  # Negative values are in KiB, i.e., 64 MiB.
+    "busy_timeout": 3000,
+}
+
+# SQL statements used by the index, kept in one place for readability.
+_SQL_COUNT_JOBS = "SELECT COUNT(*) FROM jobs"
+_SQL_COUNT_JOBS_BY_ID = "SELECT COUNT(*) FROM jobs WHERE id = ?"
+_SQL_INSERT_JOB = (
+    "INSERT INTO jobs (id, timestamp, metadata, hash, config) VALUES (?, ?, ?, ?, ?)"
+)
+_SQL_INSERT_DEPENDENCY = (
+    "INSERT INTO job_dependencies (child_id, parent_id) VALUES (?, ?)"
+)
+_SQL_DELETE_JOB = "DELETE FROM jobs WHERE id = ?"
+_SQL_DELETE_DEPENDENCIES = "DELETE FROM job_dependencies WHERE child_id = ?"
+_SQL_FIND_DEPENDENTS = """
+    SELECT DISTINCT id, timestamp, metadata, hash, config
+    FROM job_dependencies JOIN jobs ON child_id = id
+    WHERE parent_id = ?
+"""
+# The union removes duplicates, so jobs reachable via multiple paths are only returned
+# once.
+_SQL_FIND_DEPENDENTS_RECURSIVE = """
+    WITH RECURSIVE dependents (id) AS (
+        SELECT child_id FROM job_dependencies WHERE parent_id = ?
+        UNION
+        SELECT child_id FROM job_dependencies
+        JOIN dependents ON parent_id = dependents.id
+    )
+    SELECT jobs.id, timestamp, metadata, hash, config
+    FROM dependents JOIN jobs ON dependents.id = jobs.id
+"""
+
 
 class Index:
     """Job index for efficient searching."""
@@ -22,22 +83,85 @@ class Index:
         """
         self.storage = storage
         self._path = storage.root / "index.sqlite"
+        self._connection: Optional[sqlite3.Connection] = None
+        # The config of a committed job is immutable, so it is parsed only once. Jobs
+        # are created for each result, since their metadata may change.
+        self._config_cache: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
 
         if not self._path.exists():
             self.rebuild()
+            return
+
+        cursor = self.connection.execute("PRAGMA user_version")
+        if cursor.fetchone()[0] != SCHEMA_VERSION:
+            self.rebuild()
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        """The connection to the index database, which is shared by all queries."""
+        if self._connection is None:
+            self._connection = _connect(self._path)
+        return self._connection
+
+    def close(self) -> None:
+        """Closes the connection to the index database.
+
+        Before closing, statistics are refreshed if needed. Closing the last connection
+        checkpoints the write-ahead log and removes the `-wal` and `-shm` files. The
+        connection is reopened automatically when the index is used again.
+        """
+        if self._connection is not None:
+            self._connection.execute("PRAGMA optimize")
+            self._connection.close()
+            self._connection = None
+
+    def analyze(self) -> None:
+        """Updates the statistics used by SQLite for planning queries.
+
+        Statistics are collected when rebuilding the index and refreshed when closing
+        it. This method may be called after adding or removing many jobs.
+        """
+        self.connection.execute("ANALYZE")
+        self.connection.execute("PRAGMA optimize")
 
     def rebuild(self) -> None:
-        """Rebuilds the index from the storage."""
-        if self._path.exists():
-            self._path.unlink()
+        """Rebuilds the index from the storage.
 
-        with Transaction(self._path) as transaction:
+        The new index is built in a temporary file that replaces the current index only
+        once it is complete, so that the current index stays intact if rebuilding fails.
+        """
+        self._config_cache.clear()
+
+        temporary_path = self._path.with_name(f"{self._path.name}.tmp")
+        if temporary_path.exists():
+            temporary_path.unlink()
+
+        try:
+            connection = _connect(temporary_path)
+            try:
+                self._build(connection)
+            finally:
+                connection.close()
+        except BaseException:
+            if temporary_path.exists():
+                temporary_path.unlink()
+            raise
+
+        # Closing the connection checkpoints the write-ahead log, which must not be
+        # left behind for the replaced database file.
+        self.close()
+        os.replace(temporary_path, self._path)
+
+    def _build(self, connection: sqlite3.Connection) -> None:
+        with Transaction(connection) as transaction:
             transaction.execute(
                 """
                 CREATE TABLE jobs (
                     id TEXT PRIMARY KEY,
-                    timestamp TEXT NOT NULL,
-                    metadata JSON NOT NULL
+                    timestamp INTEGER NOT NULL,
+                    metadata JSON NOT NULL,
+                    hash TEXT NOT NULL,
+                    config JSON NOT NULL
                 )
                 """
             )
@@ -51,38 +175,39 @@ class Index:
                 )
                 """
             )
+            _create_indices(transaction)
 
-            job_data = []
-            job_dependency_data: list[tuple[str, str]] = []
+            # Job rows are streamed into the database so that the serialized metadata
+            # of all jobs does not need to be held in memory at once. Dependency rows
+            # are small and collected on the way.
+            job_dependency_data: List[Tuple[str, str]] = []
 
-            for job in self.storage.jobs():
-                assert job.id is not None
-                assert job.timestamp is not None
+            def job_data() -> Iterator[Tuple[str, int, str, str, str]]:
+                jobs = iter(self.storage.jobs())
 
-                job_data.append(
-                    (job.id, job.timestamp.isoformat(), json.dumps(job.metadata))
-                )
+                # Loading a job is dominated by reading its files, so batches of jobs
+                # are loaded in parallel. The database is written by this thread only.
+                with ThreadPoolExecutor() as executor:
+                    while True:
+                        batch = list(islice(jobs, REBUILD_BATCH_SIZE))
+                        if len(batch) == 0:
+                            break
 
-                job_dependency_data.extend(
-                    (job.id, dependency.job)
-                    for dependency in job.dependencies
-                    if isinstance(dependency, JobDependency)
-                )
+                        for job_row, dependency_rows in executor.map(_job_rows, batch):
+                            job_dependency_data.extend(dependency_rows)
+                            yield job_row
 
-            transaction.executemany(
-                "INSERT INTO jobs (id, timestamp, metadata) VALUES (?, ?, ?)",
-                job_data,
-            )
-            transaction.executemany(
-                "INSERT INTO job_dependencies (child_id, parent_id) VALUES (?, ?)",
-                job_dependency_data,
-            )
+            transaction.executemany(_SQL_INSERT_JOB, job_data())
+            transaction.executemany(_SQL_INSERT_DEPENDENCY, job_dependency_data)
+
+            # Collect statistics so that the query planner picks the indices.
+            transaction.execute("ANALYZE")
+            transaction.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
 
     def __len__(self) -> int:
         """Returns the number of jobs in the index."""
-        with Transaction(self._path) as transaction:
-            transaction.execute("SELECT COUNT(*) FROM jobs")
-            return transaction.fetchone()[0]
+        cursor = self.connection.execute(_SQL_COUNT_JOBS)
+        return cursor.fetchone()[0]
     
     def __contains__(self, job: Job) -> bool:
         """Checks if a job is in the index.
@@ -96,12 +221,8 @@ class Index:
         if job.id is None:
             raise ValueError("Job ID is not set")
 
-        with Transaction(self._path) as transaction:
-            transaction.execute(
-                "SELECT COUNT(*) FROM jobs WHERE id = ?",
-                (job.id,)
-            )
-            return transaction.fetchone()[0] > 0
+        cursor = self.connection.execute(_SQL_COUNT_JOBS_BY_ID, (job.id,))
+        return cursor.fetchone()[0] > 0
 
     def add(self, job: Job) -> None:
         """Adds a job to the index.
@@ -112,23 +233,11 @@ class Index:
         if job not in self.storage:
             raise ValueError(f"Job not in storage: {job}")
 
-        # Both should be set for jobs in the storage.
-        assert job.id is not None
-        assert job.timestamp is not None
+        job_row, dependency_rows = _job_rows(job)
 
-        with Transaction(self._path) as transaction:
-            transaction.execute(
-                "INSERT INTO jobs (id, timestamp, metadata) VALUES (?, ?, ?)",
-                (job.id, job.timestamp.isoformat(), json.dumps(job.metadata))
-            )
-            transaction.executemany(
-                "INSERT INTO job_dependencies (child_id, parent_id) VALUES (?, ?)",
-                [
-                    (job.id, dependency.job)
-                    for dependency in job.dependencies
-                    if isinstance(dependency, JobDependency)
-                ]
-            )
+        with Transaction(self.connection) as transaction:
+            transaction.execute(_SQL_INSERT_JOB, job_row)
+            transaction.executemany(_SQL_INSERT_DEPENDENCY, dependency_rows)
 
     def remove(self, job: Job) -> None:
         """Removes a job from the index.
@@ -139,15 +248,14 @@ class Index:
         if job.id is None:
             raise ValueError("Job ID is not set")
 
-        with Transaction(self._path) as transaction:
-            transaction.execute(
-                "DELETE FROM jobs WHERE id = ?",
-                (job.id,)
-            )
-            transaction.execute(
-                "DELETE FROM job_dependencies WHERE child_id = ? OR parent_id = ?",
-                (job.id, job.id)
-            )
+        with Transaction(self.connection) as transaction:
+            # Foreign keys are not enforced, since jobs may depend on jobs that are
+            # missing from the index. Jobs with dependents are not removed by the
+            # repository, so only the dependencies of the job itself are deleted.
+            transaction.execute(_SQL_DELETE_DEPENDENCIES, (job.id,))
+            transaction.execute(_SQL_DELETE_JOB, (job.id,))
+
+        self._config_cache.pop(job.id, None)
 
     def find(self, query: Dict[str, Any], latest: bool = False) -> List[Job]:
         """Finds jobs by tags.
@@ -160,21 +268,55 @@ class Index:
         Returns:
             The jobs that match the given query.
         """
-        sql_query = f"SELECT id, timestamp, metadata FROM jobs WHERE {mongo_to_sql(query)}"  # noqa: E501
+        condition, parameters = mongo_to_sql(query)
+        sql_query = (
+            "SELECT id, timestamp, metadata, hash, config FROM jobs "
+            f"WHERE {condition}"
+        )
         if latest:
             sql_query += " ORDER BY timestamp DESC LIMIT 1"
 
-        with Transaction(self._path) as transaction:
-            transaction.execute(sql_query)
-            results = transaction.fetchall()
+        results = self.connection.execute(sql_query, parameters).fetchall()
+        return [self._get(*result) for result in results]
+
+    def find_many(
+        self, queries: Sequence[Tuple[Dict[str, Any], bool]]
+    ) -> List[List[Job]]:
+        """Finds jobs for multiple queries at once.
+
+        The queries are combined into a single SQL statement, which is faster than
+        calling `find` for each query.
+
+        Parameters:
+            queries: Pairs of query document and `latest` flag, as passed to `find`.
+
+        Returns:
+            The jobs matching each query, in the order of the queries.
+        """
+        results: List[List[Job]] = [[] for _ in queries]
+
+        for offset in range(0, len(queries), FIND_BATCH_SIZE):
+            selects = []
+            parameters: List[Any] = []
+
+            for index, (query, latest) in enumerate(
+                queries[offset : offset + FIND_BATCH_SIZE], start=offset
+            ):
+                condition, condition_parameters = mongo_to_sql(query)
+                select = (
+                    f"SELECT {index}, id, timestamp, metadata, hash, config FROM jobs "
+                    f"WHERE {condition}"
+                )
+                if latest:
+                    select = f"SELECT * FROM ({select} ORDER BY timestamp DESC LIMIT 1)"
+                selects.append(select)
+                parameters.extend(condition_parameters)
+
+            sql_query = " UNION ALL ".join(selects)
+            for index, *result in self.connection.execute(sql_query, parameters):
+                results[index].append(self._get(*result))
 
-        jobs = []
-        for result in results:
-            job_id = result[0]
-            cached_timestamp = datetime.fromisoformat(result[1])
-            cached_metadata = json.loads(result[2])
-            jobs.append(self.storage.get(job_id, cached_timestamp, cached_metadata))
-        return jobs
+        return results
 
     def find_dependents(self, job: Job, recursive: bool = False) -> Set[Job]:
         """Finds jobs that directly depend on the given job.
@@ -189,43 +331,136 @@ class Index:
         if job.id is None:
             raise ValueError("Job ID is not set")
 
-        with Transaction(self._path) as transaction:
-            transaction.execute(
-                """SELECT child_id, timestamp, metadata
-                FROM job_dependencies JOIN jobs ON child_id = id
-                WHERE parent_id = ?""",
-                (job.id,)
-            )
-            results = transaction.fetchall()
-
-        dependents = dict()
-
-        for result in results:
-            job_id = result[0]
-            cached_timestamp = datetime.fromisoformat(result[1])
-            cached_metadata = json.loads(result[2])
-
-            dependent_job = self.storage.get(job_id, cached_timestamp, cached_metadata)
-            dependents[dependent_job.id] = dependent_job
-
-            if recursive:
-                dependents.update({
-                    job.id: job
-                    for job in self.find_dependents(dependent_job, recursive=True)
-                })
-
-        return set(dependents.values())
+        if recursive:
+            sql_query = _SQL_FIND_DEPENDENTS_RECURSIVE
+        else:
+            sql_query = _SQL_FIND_DEPENDENTS
+
+        results = self.connection.execute(sql_query, (job.id,)).fetchall()
+        return {self._get(*result) for result in results}
+
+    def _get(
+        self, job_id: str, timestamp: int, metadata: str, hash: str, config: str
+    ) -> Job:
+        parsed_config = self._config_cache.get(job_id)
+
+        if parsed_config is None:
+            parsed_config = r3.utils.load_json(config)
+            self._config_cache[job_id] = parsed_config
+            if len(self._config_cache) > CONFIG_CACHE_SIZE:
+                self._config_cache.popitem(last=False)
+        else:
+            self._config_cache.move_to_end(job_id)
+
+        return self.storage.get(
+            job_id,
+            _load_timestamp(timestamp),
+            r3.utils.load_json(metadata),
+            hash,
+            # Shallow copy so that top-level changes do not affect other jobs.
+            dict(parsed_config),
+        )
+
+
+def _job_rows(
+    job: Job,
+) -> Tuple[Tuple[str, int, str, str, str], List[Tuple[str, str]]]:
+    # Both should be set for jobs in the storage.
+    assert job.id is not None
+    assert job.timestamp is not None
+
+    job_row = (
+        job.id,
+        _dump_timestamp(job.timestamp),
+        _dump_metadata(job),
+        job.hash(),
+        _dump_config(job),
+    )
+    dependency_rows = [
+        (job.id, dependency.job)
+        for dependency in job.dependencies
+        if isinstance(dependency, JobDependency)
+    ]
+    return job_row, dependency_rows
+
+
+# Timestamps are stored as integer microseconds since the epoch, which are compact and
+# cheap to convert. Job timestamps are naive datetimes, so no time zone is involved.
+_EPOCH = datetime(1970, 1, 1)
+_MICROSECOND = timedelta(microseconds=1)
+
+
+def _dump_timestamp(timestamp: datetime) -> int:
+    return (timestamp - _EPOCH) // _MICROSECOND
+
+
+def _load_timestamp(value: int) -> datetime:
+    return _EPOCH + value * _MICROSECOND
+
+
+def _dump_metadata(job: Job) -> str:
+    # The metadata dictionary may be modified in place, so the serialized metadata is
+    # not cached on the job. Compact separators keep index rows small.
+    return r3.utils.dump_json(job.metadata)
+
+
+def _dump_config(job: Job) -> str:
+    # The config of committed jobs is immutable and can be cached without invalidation.
+    # Non-JSON values, if any, are cached as strings. `Job.hash` and `Job.dependencies`
+    # only rely on values that are strings already.
+    return r3.utils.dump_json(job._config, default=str)
+
+
+def _create_indices(transaction: sqlite3.Cursor) -> None:
+    # Reverse dependency lookup, used by `find_dependents`. The index covers the child
+    # id so that the dependency table itself does not need to be read.
+    transaction.execute(
+        """
+        CREATE INDEX IF NOT EXISTS job_dependencies_parent_id_child_id
+        ON job_dependencies (parent_id, child_id)
+        """
+    )
+    # Dependency lookup by child id, used when deleting jobs.
+    transaction.execute(
+        """
+        CREATE INDEX IF NOT EXISTS job_dependencies_child_id
+        ON job_dependencies (child_id)
+        """
+    )
+    # Used by `find` for finding the latest job.
+    transaction.execute(
+        "CREATE INDEX IF NOT EXISTS jobs_timestamp ON jobs (timestamp DESC)"
+    )
+
+
+def _connect(path: Path) -> sqlite3.Connection:
+    # Transactions are managed explicitly by `Transaction`.
+    connection = sqlite3.connect(
+        str(path),
+        isolation_level=None,
+        check_same_thread=False,
+        cached_statements=STATEMENT_CACHE_SIZE,
+    )
+    connection.execute(f"PRAGMA journal_mode = {JOURNAL_MODE}")
+    for name, value in CONNECTION_PRAGMAS.items():
+        connection.execute(f"PRAGMA {name} = {value}")
+    return connection
 
 
 class Transaction:
-    def __init__(self, path: Path) -> None:
-        self.path = str(path)
+    def __init__(self, connection: sqlite3.Connection) -> None:
+        self.connection = connection
 
     def __enter__(self) -> sqlite3.Cursor:
-        self.connection = sqlite3.connect(self.path)
         self.cursor = self.connection.cursor()
+        # Transactions are only used for writing. Acquiring the write lock immediately
+        # avoids failing to upgrade a read lock when other connections write as well.
+        self.cursor.execute("BEGIN IMMEDIATE")
         return self.cursor
 
     def __exit__(self, exc_type, exc_value, traceback) -> None:
-        self.connection.commit()
-        self.connection.close()
+        if exc_type is None:
+            self.cursor.execute("COMMIT")
+        else:
+            self.cursor.execute("ROLLBACK")
+        self.cursor.close()
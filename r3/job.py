@@ -1,25 +1,48 @@
 import abc
+import functools
 import os
 import re
+import time
 import warnings
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from pathlib import Path
-from typing import Any, Dict, Mapping, Optional, Sequence, Union
-
-import yaml
+from typing import Any, Callable, Dict, Mapping, Optional, Sequence, Type, Union
 
 import r3.utils
 
+# Hashing is partially I/O-bound, so more threads than cores are used.
+_HASH_WORKERS = min(32, (os.cpu_count() or 1) * 4)
+
+# Job files that are not part of the job hash.
+_UNHASHED_FILES = frozenset(("r3.yaml", "metadata.yaml"))
+
 
 class Job:
     """A computational job."""
 
+    # Repositories may hold many job instances, so per-instance dictionaries are
+    # avoided.
+    __slots__ = (
+        "_path",
+        "id",
+        "_metadata",
+        "_metadata_from_cache",
+        "_timestamp",
+        "_files",
+        "__config",
+        "_dependencies",
+        "_hash",
+    )
+
     def __init__(
         self,
         path: Union[str, os.PathLike],
         id: Optional[str] = None,
         cached_timestamp: Optional[datetime] = None,
         cached_metadata: Optional[Dict[str, Any]] = None,
+        cached_hash: Optional[str] = None,
+        cached_config: Optional[Dict[str, Any]] = None,
     ) -> None:
         """Initializes a job instance.
 
@@ -27,6 +50,10 @@ class Job:
             path: Path to the job's root directory.
             id: Job id for committed jobs. This is set automatically for jobs retrieved
                 from a repository.
+            cached_timestamp: Timestamp of the job, if available in the cache.
+            cached_metadata: Metadata of the job, if available in the cache.
+            cached_hash: Hash of the job, if available in the cache.
+            cached_config: Contents of the job's `r3.yaml`, if available in the cache.
         """
         self._path = Path(path).absolute()
         self.id = id
@@ -35,9 +62,9 @@ class Job:
         self._metadata_from_cache = cached_metadata is not None
         self._timestamp = cached_timestamp
         self._files: Optional[Dict[Path, Path]] = None
-        self.__config: Optional[Dict[str, Any]] = None
+        self.__config: Optional[Dict[str, Any]] = cached_config
         self._dependencies: Optional[Sequence["Dependency"]] = None
-        self._hash: Optional[str] = None
+        self._hash: Optional[str] = cached_hash
 
     @property
     def path(self) -> Path:
@@ -51,10 +78,12 @@ class Job:
         Changes to this dictionary are not automatically written to the job's metadata
         file. Use `save_metadata` to save changes to the metadata file.
         """
-        if self._metadata is None:
+        metadata = self._metadata
+        if metadata is None:
             self.reload_metadata()
-        assert self._metadata is not None
-        return self._metadata
+            metadata = self._metadata
+            assert metadata is not None
+        return metadata
 
     @metadata.setter
     def metadata(self, metadata: Dict[str, Any]) -> None:
@@ -70,10 +99,11 @@ class Job:
 
     def reload_metadata(self) -> None:
         """Reloads the metadata from the metadata file."""
-        if (self.path / "metadata.yaml").is_file():
-            with open(self.path / "metadata.yaml", "r") as metadata_file:
-                self._metadata = yaml.safe_load(metadata_file)
-        else:
+        try:
+            with open(self.path / "metadata.yaml", "rb") as metadata_file:
+                # An empty metadata file is parsed as None.
+                self._metadata = r3.utils.load_yaml(metadata_file) or dict()
+        except FileNotFoundError:
             self._metadata = dict()
         self._metadata_from_cache = False
 
@@ -83,7 +113,7 @@ class Job:
         This method has to be called after modifying the metadata dictionary.
         """
         with open(self.path / "metadata.yaml", "w") as metadata_file:
-            yaml.dump(self.metadata, metadata_file)
+            r3.utils.dump_yaml(self.metadata, metadata_file)
 
     @property
     def timestamp(self) -> Optional[datetime]:
@@ -117,13 +147,14 @@ class Job:
     def files(self) -> Mapping[Path, Path]:
         """Files belonging to this job."""
         if self._files is None:
-            ignore = self._config.get("ignore", [])
-
-            for dependency in self.dependencies:
-                ignore.append(f"/{dependency.destination}")
+            # The ignore patterns are built anew to not modify the job config.
+            ignore = (
+                *self._config.get("ignore", ()),
+                *(f"/{dependency.destination}" for dependency in self.dependencies),
+            )
 
             self._files = {
-                file: (self.path / file).absolute()
+                file: self.path / file
                 for file in r3.utils.find_files(self.path, ignore)
             }
 
@@ -147,13 +178,7 @@ class Job:
     @property
     def _config(self) -> Dict[str, Any]:
         if self.__config is None:
-            if (self.path / "r3.yaml").is_file():
-                with open(self.path / "r3.yaml", "r") as config_file:
-                    self.__config = yaml.safe_load(config_file)
-            else:
-                self.__config = dict()
-
-            self.__config.setdefault("dependencies", [])
+            self.__config = _load_config(self.path / "r3.yaml")
 
         return self.__config
 
@@ -161,28 +186,55 @@ class Job:
     def _config(self, config: Dict[str, Any]) -> None:
         self.__config = config
 
-    def hash(self, recompute: bool = False) -> str:
+    def hash(
+        self,
+        recompute: bool = False,
+        file_hash_cache: Optional[r3.utils.FileHashCache] = None,
+    ) -> str:
         """Returns the hash of this job.
 
+        For committed jobs, the hash stored in the job config at commit time is
+        returned unless `recompute` is set, since committed jobs are immutable.
+
         Parameters:
             recompute: This method uses cashing to compute the job hash only when
                 necessary. If set to `True`, this will recompute the job hash in any
                 case.
+            file_hash_cache: Optional cache of file hashes. If given, files that have
+                not changed since they were last hashed are not read again.
         """
-        if self._hash is None or recompute:
-            hashes = dict()
+        hash_file: Callable[[Path], str]
+        if file_hash_cache is None:
+            hash_file = r3.utils.hash_file
+        else:
+            hash_file = file_hash_cache.hash_file
 
-            for destination, source in self.files.items():
-                if destination in (Path("r3.yaml"), Path("metadata.yaml")):
-                    continue
+        if self._hash is None and not recompute and self.id is not None:
+            self._hash = self._config.get("hashes", {}).get(".")
 
-                hashes[str(destination)] = r3.utils.hash_file(source)
+        if self._hash is None or recompute:
+            files: Dict[str, Path] = {}
+            for destination, source in self.files.items():
+                key = str(destination)
+                if key not in _UNHASHED_FILES:
+                    files[key] = source
+
+            # hashlib releases the GIL while hashing, so files are hashed in parallel.
+            if len(files) > 1:
+                with ThreadPoolExecutor(max_workers=_HASH_WORKERS) as executor:
+                    hashes = dict(zip(
+                        files.keys(), executor.map(hash_file, files.values())
+                    ))
+            else:
+                hashes = {
+                    destination: hash_file(source)
+                    for destination, source in files.items()
+                }
 
             for dependency in self.dependencies:
                 hashes[str(dependency.destination)] = dependency.hash()
 
-            index = "\n".join(f"{path} {hashes[path]}" for path in sorted(hashes))
-            hashes["."] = r3.utils.hash_str(index)
+            hashes["."] = r3.utils.hash_index(hashes)
 
             self._config["hashes"] = hashes  # type: ignore
             self._hash = hashes["."]
@@ -193,6 +245,8 @@ class Job:
 class Dependency(abc.ABC):
     """Dependency base class."""
 
+    __slots__ = ("destination",)
+
     def __init__(self, destination: Union[os.PathLike, str]) -> None:
         """Initializes the dependency.
 
@@ -214,18 +268,9 @@ class Dependency(abc.ABC):
                 dictionary depends on the type of dependency. See the documentation of
                 the specific dependency class for more information.
         """
-        if "job" in config:
-            return JobDependency.from_config(config)
-        if "find_latest" in config:
-            return FindLatestDependency.from_config(config)
-        if "find_all" in config:
-            return FindAllDependency.from_config(config)
-        if "query" in config:
-            return QueryDependency.from_config(config)
-        if "query_all" in config:
-            return QueryAllDependency.from_config(config)
-        if "repository" in config:
-            return GitDependency.from_config(config)
+        for key, dependency_class in _DEPENDENCY_CLASSES.items():
+            if key in config:
+                return dependency_class.from_config(config)
 
         raise ValueError(f"Unrecognized dependency config: {config}")
 
@@ -251,6 +296,8 @@ class Dependency(abc.ABC):
 class JobDependency(Dependency):
     """A dependency on another job."""
 
+    __slots__ = ("job", "source", "find_latest", "find_all", "query", "query_all")
+
     def __init__(
         self,
         destination: Union[os.PathLike, str],
@@ -356,6 +403,8 @@ class JobDependency(Dependency):
 class FindLatestDependency(Dependency):
     """A dependency to the latest job determined by a query."""
 
+    __slots__ = ("source", "query")
+
     def __init__(
         self,
         destination: Union[os.PathLike, str],
@@ -427,6 +476,8 @@ class FindLatestDependency(Dependency):
 
 class FindAllDependency(Dependency):
     """A dependency to all jobs determined by a query."""
+
+    __slots__ = ("query",)
     
     def __init__(
         self,
@@ -500,6 +551,8 @@ class FindAllDependency(Dependency):
 class QueryDependency(Dependency):
     """A dependency to the latest job determined by a query."""
 
+    __slots__ = ("source", "query")
+
     def __init__(
         self,
         destination: Union[os.PathLike, str],
@@ -574,6 +627,8 @@ class QueryDependency(Dependency):
 class QueryAllDependency(Dependency):
     """A dependency to all jobs determined by a query."""
 
+    __slots__ = ("query_all",)
+
     def __init__(
         self,
         destination: Union[os.PathLike, str],
@@ -647,6 +702,8 @@ class QueryAllDependency(Dependency):
 class GitDependency(Dependency):
     """A dependency to a git repository."""
 
+    __slots__ = ("source", "repository", "commit", "branch", "tag")
+
     def __init__(
         self,
         destination: Union[os.PathLike, str],
@@ -686,17 +743,7 @@ class GitDependency(Dependency):
     @property
     def repository_path(self) -> Path:
         """Returns the path where the repository will stored in R3."""
-        https_pattern = r"^https://github\.com/([^/]+)/([^/\.]+)(?:\.git)?$"
-        match = re.match(https_pattern, self.repository)
-        if match:
-            return Path("git") / "github.com" / match.group(1) / match.group(2)
-
-        ssh_pattern = r"^git@github\.com:([^/]+)/([^/\.]+)(?:\.git)?$"
-        match = re.match(ssh_pattern, self.repository)
-        if match:
-            return Path("git") / "github.com" / match.group(1) / match.group(2)
-
-        raise ValueError(f"Unrecognized git url: {self.repository}")
+        return _repository_path(self.repository)
 
     @staticmethod
     def from_config(config: Dict[str, str]) -> "GitDependency":
@@ -743,3 +790,61 @@ class GitDependency(Dependency):
     def hash(self) -> str:
         """Returns the hash of the dependency."""
         return r3.utils.hash_str(f"{self.repository_path}@{self.commit}/{self.source}")
+
+
+# Maps the key identifying the type of a dependency config to the dependency class. The
+# order matters, e.g., resolved job dependencies may also contain a query.
+_DEPENDENCY_CLASSES: Dict[str, Type[Dependency]] = {
+    "job": JobDependency,
+    "find_latest": FindLatestDependency,
+    "find_all": FindAllDependency,
+    "query": QueryDependency,
+    "query_all": QueryAllDependency,
+    "repository": GitDependency,
+}
+
+
+def _load_config(path: Path) -> Dict[str, Any]:
+    try:
+        stat = os.stat(path)
+
+        # Files modified very recently might be modified again without changing their
+        # modification time, so they are parsed without caching.
+        parse = _parse_config
+        if time.time_ns() - stat.st_mtime_ns <= r3.utils.FileHashCache.RACY_INTERVAL_NS:
+            parse = _parse_config.__wrapped__  # type: ignore
+
+        config = parse(str(path), stat.st_mtime_ns, stat.st_size, stat.st_ino)
+    except FileNotFoundError:
+        return {"dependencies": []}
+
+    # Jobs replace top-level values like "dependencies" or "hashes" but do not modify
+    # nested values, so a shallow copy protects the cached config.
+    return dict(config)
+
+
+# Parsed job configs are shared across job instances. The key includes the
+# modification time, size and inode, so changed files are parsed again.
+@functools.lru_cache(maxsize=4096)
+def _parse_config(path: str, mtime_ns: int, size: int, inode: int) -> Dict[str, Any]:
+    with open(path, "rb") as config_file:
+        config = r3.utils.load_yaml(config_file) or dict()
+
+    config.setdefault("dependencies", [])
+    return config
+
+
+_GITHUB_URL_PATTERNS = (
+    re.compile(r"^https://github\.com/([^/]+)/([^/\.]+)(?:\.git)?$"),
+    re.compile(r"^git@github\.com:([^/]+)/([^/\.]+)(?:\.git)?$"),
+)
+
+
+@functools.lru_cache(maxsize=256)
+def _repository_path(repository: str) -> Path:
+    for pattern in _GITHUB_URL_PATTERNS:
+        match = pattern.match(repository)
+        if match:
+            return Path("git") / "github.com" / match.group(1) / match.group(2)
+
+    raise ValueError(f"Unrecognized git url: {repository}")
@@ -1,13 +1,55 @@
 """Converts MongoDB query documents to SQL"""
 
 import abc
+import functools
 from dataclasses import dataclass
-from typing import Any, Dict, List
+from typing import Any, Callable, Dict, List, Tuple, Type, Union
 
+# Maximum number of converted queries that are cached.
+QUERY_CACHE_SIZE = 1024
 
-def mongo_to_sql(query: Dict[str, Any]) -> str:
-    """Converts a MongoDB query document to a SQL query."""
-    return Query.from_mongo(query).to_sql()
+
+def mongo_to_sql(query: Dict[str, Any]) -> Tuple[str, List[Any]]:
+    """Converts a MongoDB query document to a SQL query.
+
+    Conversions are cached, since the same queries are typically used repeatedly, e.g.
+    when resolving dependencies.
+
+    Returns:
+        The SQL condition with `?` placeholders and the values to bind to them.
+    """
+    try:
+        sql, parameters = _cached_mongo_to_sql(_freeze(query))
+    except TypeError:
+        # Queries containing unhashable values are converted without caching.
+        return Query.from_mongo(query).simplify().to_sql()
+
+    return sql, list(parameters)
+
+
+def _freeze(value: Any) -> Any:
+    # Values are tagged with their type since, e.g., `True == 1` in Python, but the
+    # queries must not share a cache entry.
+    if isinstance(value, dict):
+        return dict, tuple((key, _freeze(item)) for key, item in value.items())
+    if isinstance(value, list):
+        return list, tuple(_freeze(item) for item in value)
+    return type(value), value
+
+
+def _thaw(frozen: Any) -> Any:
+    kind, value = frozen
+    if kind is dict:
+        return {key: _thaw(item) for key, item in value}
+    if kind is list:
+        return [_thaw(item) for item in value]
+    return value
+
+
+@functools.lru_cache(maxsize=QUERY_CACHE_SIZE)
+def _cached_mongo_to_sql(frozen_query: Any) -> Tuple[str, Tuple[Any, ...]]:
+    sql, parameters = Query.from_mongo(_thaw(frozen_query)).simplify().to_sql()
+    return sql, tuple(parameters)
 
 
 class Query(abc.ABC):
@@ -19,79 +61,124 @@ class Query(abc.ABC):
 
         if len(query) > 1:
             return AndQuery([
-                Query.from_mongo({key: value}) for key, value in query.items()
+                _query_from_mongo_item(key, value) for key, value in query.items()
             ])
 
         key, value = next(iter(query.items()))
+        return _query_from_mongo_item(key, value)
 
-        if key == "$and":
-            assert isinstance(value, list)
-            return AndQuery([
-                Query.from_mongo(subquery) for subquery in value
-            ])
-        
-        if key == "$or":
-            assert isinstance(value, list)
-            return OrQuery([
-                Query.from_mongo(subquery) for subquery in value
-            ])
-    
-        if key == "$not":
-            return NotQuery(Query.from_mongo(value))
-    
-        if key == "$nor":
-            assert isinstance(value, list)
-            return NorQuery([
-                Query.from_mongo(subquery) for subquery in value
-            ])
-    
-        if key.startswith("$"):
-            raise ValueError(f"Unsupported operator: {key}")
-    
-        return FieldQuery(key, Condition.from_mongo(value))
+    def simplify(self) -> "Query":
+        """Returns an equivalent query without redundant nesting."""
+        return self
 
     @abc.abstractmethod
-    def to_sql(self) -> str:
-        """Converts the query to a SQL query."""
+    def to_sql(self) -> Tuple[str, List[Any]]:
+        """Converts the query to a SQL query and the values to bind to it."""
         pass
 
 
+def _query_from_mongo_item(key: str, value: Any) -> "Query":
+    if not key.startswith("$"):
+        return FieldQuery(key, Condition.from_mongo(value))
+
+    query_class = _LOGICAL_QUERY_CLASSES.get(key)
+    if query_class is None:
+        raise ValueError(f"Unsupported operator: {key}")
+
+    if query_class is NotQuery:
+        return NotQuery(Query.from_mongo(value))
+
+    assert isinstance(value, list)
+    return query_class([Query.from_mongo(subquery) for subquery in value])
+
+
 @dataclass
 class TrueQuery(Query):
-    def to_sql(self) -> str:
-        return "TRUE"
+    def to_sql(self) -> Tuple[str, List[Any]]:
+        return "TRUE", []
 
 
 @dataclass
 class AndQuery(Query):
     queries: List[Query]
 
-    def to_sql(self) -> str:
-        return " AND ".join(f"({query.to_sql()})" for query in self.queries)
+    def simplify(self) -> Query:
+        return _flatten(AndQuery, self.queries)
+
+    def to_sql(self) -> Tuple[str, List[Any]]:
+        return _join(" AND ", self.queries)
 
 
 @dataclass
 class OrQuery(Query):
     queries: List[Query]
 
-    def to_sql(self) -> str:
-        return " OR ".join(f"({query.to_sql()})" for query in self.queries)
+    def simplify(self) -> Query:
+        return _flatten(OrQuery, self.queries)
+
+    def to_sql(self) -> Tuple[str, List[Any]]:
+        return _join(" OR ", self.queries)
 
 
 @dataclass
 class NotQuery(Query):
     query: Query
 
-    def to_sql(self) -> str:
-        return f"NOT ({self.query.to_sql()})"
+    def simplify(self) -> Query:
+        query = self.query.simplify()
+
+        if isinstance(query, NotQuery):
+            return query.query
+
+        if isinstance(query, OrQuery):
+            return NorQuery(query.queries)
+
+        return NotQuery(query)
+
+    def to_sql(self) -> Tuple[str, List[Any]]:
+        sql, parameters = self.query.to_sql()
+        return f"NOT ({sql})", parameters
 
 
 @dataclass
 class NorQuery(Query):
     queries: List[Query]
 
-    def to_sql(self) -> str:
-        return f"NOT ({OrQuery(self.queries).to_sql()})"
+    def simplify(self) -> Query:
+        return NotQuery(OrQuery(self.queries)).simplify()
+
+    def to_sql(self) -> Tuple[str, List[Any]]:
+        sql, parameters = OrQuery(self.queries).to_sql()
+        return f"NOT ({sql})", parameters
+
+
+def _flatten(
+    query_class: Type[Union[AndQuery, OrQuery]], queries: List[Query]
+) -> Query:
+    # Nested queries of the same type are merged into their parent and queries with a
+    # single subquery are replaced by it. Empty queries are kept as they are.
+    flattened_queries: List[Query] = []
+    for query in queries:
+        query = query.simplify()
+        if isinstance(query, query_class) and len(query.queries) > 0:
+            flattened_queries.extend(query.queries)
+        else:
+            flattened_queries.append(query)
+
+    if len(flattened_queries) == 1:
+        return flattened_queries[0]
+
+    return query_class(flattened_queries)
+
+
+def _join(separator: str, queries: List[Query]) -> Tuple[str, List[Any]]:
+    sqls = []
+    parameters: List[Any] = []
+    for query in queries:
+        sql, query_parameters = query.to_sql()
+        sqls.append(f"({sql})")
+        parameters.extend(query_parameters)
+    return separator.join(sqls), parameters
 
 
 @dataclass
@@ -99,18 +186,24 @@ class FieldQuery(Query):
     field: str
     condition: "Condition"
 
-    def to_sql(self) -> str:
+    def to_sql(self) -> Tuple[str, List[Any]]:
         """Converts the field query to a SQL query."""
+        # The JSON path is part of the query structure and therefore not bound as a
+        # parameter. Quotes are escaped to keep the SQL valid for any field name.
+        path = "'$." + self.field.replace("'", "''") + "'"
+        field = f"metadata->>{path}"
+
         if not self.condition.supports_arrays:
-            return self.condition.to_sql(f"metadata->>'$.{self.field}'")
+            return self.condition.to_sql(field)
 
-        condition_value = self.condition.to_sql("value")
-        condition_field = self.condition.to_sql(f"metadata->>'$.{self.field}'")
-        return (
-            f"CASE WHEN json_type(metadata, '$.{self.field}') = 'array' "
-            f"THEN EXISTS (SELECT 1 FROM json_each(metadata->>'$.{self.field}') WHERE {condition_value}) "  # noqa: E501
+        condition_value, value_parameters = self.condition.to_sql("value")
+        condition_field, field_parameters = self.condition.to_sql(field)
+        sql = (
+            f"CASE WHEN json_type(metadata, {path}) = 'array' "
+            f"THEN EXISTS (SELECT 1 FROM json_each({field}) WHERE {condition_value}) "
             f"ELSE {condition_field} END"
         )
+        return sql, value_parameters + field_parameters
 
 
 class Condition(abc.ABC):
@@ -121,8 +214,8 @@ class Condition(abc.ABC):
         pass
 
     @abc.abstractmethod
-    def to_sql(self, field: str) -> str:
-        """Converts the condition to a SQL query."""
+    def to_sql(self, field: str) -> Tuple[str, List[Any]]:
+        """Converts the condition to a SQL query and the values to bind to it."""
         pass
 
     @staticmethod
@@ -133,26 +226,6 @@ class Condition(abc.ABC):
             
             key, value = next(iter(value.items()))
 
-            if key == "$eq":
-                return Eq(value)
-            if key == "$ne":
-                return Ne(value)
-            if key == "$in":
-                return In(value)
-            if key == "$nin":
-                return Nin(value)
-            if key == "$gt":
-                return Gt(value)
-            if key == "$gte":
-                return Gte(value)
-            if key == "$lt":
-                return Lt(value)
-            if key == "$lte":
-                return Lte(value)
-            if key == "$glob":
-                return Glob(value)
-            if key == "$all":
-                return All(value)
             if key == "$elemMatch":
                 if not isinstance(value, dict):
                     raise ValueError(f"Invalid condition: {value}")
@@ -161,6 +234,10 @@ class Condition(abc.ABC):
                     for subkey, subvalue in value.items()
                 ])
 
+            condition_class = _CONDITION_CLASSES.get(key)
+            if condition_class is not None:
+                return condition_class(value)
+
         return Eq(value)
 
 
@@ -173,11 +250,8 @@ class Eq(Condition):
     def supports_arrays(self) -> bool:
         return True
 
-    def to_sql(self, field: str) -> str:
-        if isinstance(self.value, str):
-            return f"{field} = '{self.value}'"
-        else:
-            return f"{field} = {self.value}"
+    def to_sql(self, field: str) -> Tuple[str, List[Any]]:
+        return f"{field} = ?", [self.value]
 
 
 @dataclass
@@ -189,11 +263,8 @@ class Ne(Condition):
     def supports_arrays(self) -> bool:
         return True
 
-    def to_sql(self, field: str) -> str:
-        if isinstance(self.value, str):
-            return f"{field} != '{self.value}'"
-        else:
-            return f"{field} != {self.value}"
+    def to_sql(self, field: str) -> Tuple[str, List[Any]]:
+        return f"{field} != ?", [self.value]
 
 
 @dataclass
@@ -205,12 +276,9 @@ class In(Condition):
     def supports_arrays(self) -> bool:
         return True
 
-    def to_sql(self, field: str) -> str:
-        values = [
-            f"'{value}'" if isinstance(value, str) else str(value)
-            for value in self.values
-        ]
-        return f"{field} IN ({', '.join(values)})"
+    def to_sql(self, field: str) -> Tuple[str, List[Any]]:
+        placeholders = ", ".join("?" for _ in self.values)
+        return f"{field} IN ({placeholders})", list(self.values)
 
 
 @dataclass
@@ -222,12 +290,9 @@ class Nin(Condition):
     def supports_arrays(self) -> bool:
         return True
 
-    def to_sql(self, field: str) -> str:
-        values = [
-            f"'{value}'" if isinstance(value, str) else str(value)
-            for value in self.values
-        ]
-        return f"{field} NOT IN ({', '.join(values)})"
+    def to_sql(self, field: str) -> Tuple[str, List[Any]]:
+        placeholders = ", ".join("?" for _ in self.values)
+        return f"{field} NOT IN ({placeholders})", list(self.values)
 
 
 @dataclass
@@ -239,8 +304,8 @@ class Gt(Condition):
     def supports_arrays(self) -> bool:
         return True
 
-    def to_sql(self, field: str) -> str:
-        return f"{field} > {self.value}"
+    def to_sql(self, field: str) -> Tuple[str, List[Any]]:
+        return f"{field} > ?", [self.value]
 
 
 @dataclass
@@ -252,8 +317,8 @@ class Gte(Condition):
     def supports_arrays(self) -> bool:
         return True
 
-    def to_sql(self, field: str) -> str:
-        return f"{field} >= {self.value}"
+    def to_sql(self, field: str) -> Tuple[str, List[Any]]:
+        return f"{field} >= ?", [self.value]
 
 
 @dataclass
@@ -265,8 +330,8 @@ class Lt(Condition):
     def supports_arrays(self) -> bool:
         return True
 
-    def to_sql(self, field: str) -> str:
-        return f"{field} < {self.value}"
+    def to_sql(self, field: str) -> Tuple[str, List[Any]]:
+        return f"{field} < ?", [self.value]
 
 
 @dataclass
@@ -278,8 +343,8 @@ class Lte(Condition):
     def supports_arrays(self) -> bool:
         return True
 
-    def to_sql(self, field: str) -> str:
-        return f"{field} <= {self.value}"
+    def to_sql(self, field: str) -> Tuple[str, List[Any]]:
+        return f"{field} <= ?", [self.value]
 
 
 @dataclass
@@ -291,8 +356,8 @@ class Glob(Condition):
     def supports_arrays(self) -> bool:
         return True
 
-    def to_sql(self, field: str) -> str:
-        return f"{field} GLOB '{self.pattern}'"
+    def to_sql(self, field: str) -> Tuple[str, List[Any]]:
+        return f"{field} GLOB ?", [self.pattern]
 
 
 @dataclass
@@ -304,18 +369,24 @@ class All(Condition):
     def supports_arrays(self) -> bool:
         return False
 
-    def to_sql(self, field: str) -> str:
+    def to_sql(self, field: str) -> Tuple[str, List[Any]]:
         if len(self.values) == 0:
-            return "TRUE"
-
-        subqueries = [
-            f"EXISTS (SELECT 1 FROM json_each({field}) WHERE value = '{value}')"
-            if isinstance(value, str)
-            else f"EXISTS (SELECT 1 FROM json_each({field}) WHERE value = {value})"
-            for value in self.values
-        ]
-
-        return " AND ".join(subqueries)
+            return "TRUE", []
+
+        # A single subquery counts the distinct matching elements, instead of one
+        # subquery per value. Duplicate values have to be removed for the count to be
+        # correct. Like in SQLite, `1`, `1.0` and `True` are considered equal here.
+        values: List[Any] = []
+        for value in self.values:
+            if value not in values:
+                values.append(value)
+
+        placeholders = ", ".join("?" for _ in values)
+        sql = (
+            f"(SELECT COUNT(DISTINCT value) FROM json_each({field}) "
+            f"WHERE value IN ({placeholders})) = {len(values)}"
+        )
+        return sql, values
 
 
 @dataclass
@@ -327,8 +398,41 @@ class ElemMatch(Condition):
     def supports_arrays(self) -> bool:
         return False
 
-    def to_sql(self, field: str) -> str:
-        conditions_sql = " AND ".join(
-            condition.to_sql("value") for condition in self.conditions
+    def to_sql(self, field: str) -> Tuple[str, List[Any]]:
+        sqls = []
+        parameters: List[Any] = []
+        for condition in self.conditions:
+            sql, condition_parameters = condition.to_sql("value")
+            sqls.append(sql)
+            parameters.extend(condition_parameters)
+
+        conditions_sql = " AND ".join(sqls)
+        return (
+            f"EXISTS (SELECT 1 FROM json_each({field}) WHERE {conditions_sql})",
+            parameters,
         )
-        return f"EXISTS (SELECT 1 FROM json_each({field}) WHERE {conditions_sql})"
+
+
+# Maps logical operators to the query classes implementing them.
+_LOGICAL_QUERY_CLASSES: Dict[str, Callable[[Any], Query]] = {
+    "$and": AndQuery,
+    "$or": OrQuery,
+    "$not": NotQuery,
+    "$nor": NorQuery,
+}
+
+
+# Maps comparison operators to the condition classes implementing them. $elemMatch
+# contains nested conditions and is handled separately.
+_CONDITION_CLASSES: Dict[str, Callable[[Any], Condition]] = {
+    "$eq": Eq,
+    "$ne": Ne,
+    "$in": In,
+    "$nin": Nin,
+    "$gt": Gt,
+    "$gte": Gte,
+    "$lt": Lt,
+    "$lte": Lte,
+    "$glob": Glob,
+    "$all": All,
+}
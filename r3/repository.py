@@ -6,9 +6,8 @@ The `Repository` class should be imported not from this module but from the top-
 
 import os
 from pathlib import Path
-from typing import Any, Dict, Iterable, List, Set, Union
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Set, Tuple, Union
 
-import yaml
 from executor import execute
 
 import r3
@@ -32,11 +31,15 @@ R3_FORMAT_VERSION = "1.0.0-beta.7"
 class Repository:
     """A repository of jobs."""
 
-    def __init__(self, path: Union[str, os.PathLike]) -> None:
+    def __init__(
+        self, path: Union[str, os.PathLike], parallel_io: bool = True
+    ) -> None:
         """Initializes the repository instance.
 
         Parameters:
             path: The path to the repository.
+            parallel_io: Whether to copy files using multiple threads when committing
+                or checking out jobs. This may be slower on network file systems.
 
         Raises:
             FileNotFoundError: If the given path does not exist.
@@ -54,16 +57,34 @@ class Repository:
             raise ValueError(f"Invalid repository: {self.path}")
 
         with open(self.path / "r3.yaml") as config_file:
-            config = yaml.safe_load(config_file)
+            config = r3.utils.load_yaml(config_file)
             if config["version"] != R3_FORMAT_VERSION:
                 raise ValueError(
                     f"Invalid repository version: {config['version']}. Please migrate "
                     f"to {R3_FORMAT_VERSION}."
                 )
 
-        self._storage = Storage(self.path)
+        self._storage = Storage(self.path, parallel_io=parallel_io)
         self._index = Index(self._storage)
 
+        # Git paths (repository, commit, source) that are known to exist.
+        self._known_git_paths: Set[Tuple[str, str, str]] = set()
+
+    def close(self) -> None:
+        """Closes the connection to the job index.
+
+        The connection is reopened automatically when the repository is used again.
+        Repositories can also be used as context managers, which close the repository
+        on exit.
+        """
+        self._index.close()
+
+    def __enter__(self) -> "Repository":
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.close()
+
     @staticmethod
     def init(path: Union[str, os.PathLike]) -> "Repository":
         """Creates a new repository at the given path.
@@ -85,7 +106,7 @@ class Repository:
         r3config = {"version": R3_FORMAT_VERSION}
 
         with open(path / "r3.yaml", "w") as config_file:
-            yaml.dump(r3config, config_file)
+            r3.utils.dump_yaml(r3config, config_file)
 
         return Repository(path)
 
@@ -119,24 +140,46 @@ class Repository:
 
         if isinstance(resolved_item, GitDependency):
             assert resolved_item.commit is not None
-            repository_path = self.path / resolved_item.repository_path
-
-            if not repository_path.exists():
-                execute(
-                    f"git clone --bare {resolved_item.repository} {repository_path}"
-                )
-
-            if not r3.utils.git_commit_exists(repository_path, resolved_item.commit):
-                execute("git fetch origin *:* --force", directory=repository_path)
-
-            return r3.utils.git_path_exists(
-                repository_path,
+            key = (
+                resolved_item.repository,
                 resolved_item.commit,
-                resolved_item.source,
+                str(resolved_item.source),
             )
+            if key in self._known_git_paths:
+                return True
+
+            if self._contains_git_path(resolved_item):
+                # Commits are immutable, so the path will exist in the future as well.
+                self._known_git_paths.add(key)
+                return True
 
         return False
 
+    def _contains_git_path(self, dependency: GitDependency) -> bool:
+        assert dependency.commit is not None
+        repository_path = self.path / dependency.repository_path
+
+        if not repository_path.exists():
+            execute(f"git clone --bare {dependency.repository} {repository_path}")
+
+        # In the common case that the commit is available locally, a single git call is
+        # sufficient.
+        if r3.utils.git_path_exists(
+            repository_path, dependency.commit, dependency.source
+        ):
+            return True
+
+        if r3.utils.git_commit_exists(repository_path, dependency.commit):
+            return False
+
+        execute("git fetch origin *:* --force", directory=repository_path)
+
+        return r3.utils.git_path_exists(
+            repository_path,
+            dependency.commit,
+            dependency.source,
+        )
+
     def commit(self, job: Job) -> Job:
         """Commits a job to the repository.
         
@@ -147,6 +190,32 @@ class Repository:
             The committed job. Compared to the original job, the returned job has an id
             and the path is changed to the location in the repository.
         """
+        return self._commit(job)
+
+    def commit_many(self, jobs: Iterable[Job]) -> List[Job]:
+        """Commits multiple jobs to the repository.
+
+        This is faster than committing the jobs one by one, since the cache of file
+        hashes is loaded and saved only once. Jobs are committed in the given order, so
+        later jobs may depend on earlier ones.
+
+        Parameters:
+            jobs: The jobs to commit.
+
+        Returns:
+            The committed jobs, in the given order.
+        """
+        file_hash_cache = self._storage.file_hash_cache()
+
+        try:
+            return [self._commit(job, file_hash_cache) for job in jobs]
+        finally:
+            # Hashes of jobs committed before an error are valid nevertheless.
+            file_hash_cache.save()
+
+    def _commit(
+        self, job: Job, file_hash_cache: Optional[r3.utils.FileHashCache] = None
+    ) -> Job:
         job = self.resolve(job)  # type: ignore
 
         # REVIEW It would be nice if `resolve` would check whether the dependencies
@@ -155,19 +224,25 @@ class Repository:
             if dependency not in self:
                 raise ValueError(f"Missing dependency: {dependency}")
 
-        job = self._storage.add(job)
+        job = self._storage.add(job, file_hash_cache)
         self._index.add(job)
 
         return job
 
     def checkout(
-        self, item: Union[Dependency, Job], path: Union[str, os.PathLike]
+        self,
+        item: Union[Dependency, Job],
+        path: Union[str, os.PathLike],
+        link: bool = False,
     ) -> None:
         """Checks out a job or dependency to the given path.
         
         Parameters:
             item: The job or dependency to check out.
             path: The path to check out the job or dependency to.
+            link: Whether to hard link the files of a job instead of copying them.
+                Linked files share their content with the committed jobs, see
+                `Storage.checkout_job`.
         """
         resolved_item = self.resolve(item)
 
@@ -175,7 +250,7 @@ class Repository:
             for dependency in resolved_item:
                 self._storage.checkout(dependency, path)
         else:
-            self._storage.checkout(resolved_item, path)
+            self._storage.checkout(resolved_item, path, link=link)
 
     def remove(self, job: Job) -> None:
         """Removes a job from the repository.
@@ -235,6 +310,15 @@ class Repository:
         """
         self._index.rebuild()
 
+    def analyze_index(self) -> None:
+        """Updates the statistics used for querying the job index.
+
+        Statistics are collected when rebuilding the index and refreshed when closing
+        the repository. This method may be called after committing or removing many
+        jobs in a long-running process.
+        """
+        self._index.analyze()
+
     def resolve(
         self,
         item: Union[Job, Dependency],
@@ -273,10 +357,38 @@ class Repository:
         if not isinstance(job.dependencies, list):
             raise ValueError("Dependencies are not writeable.")
 
+        # The queries of all query dependencies are run in a single batch.
+        query_dependencies = [
+            dependency
+            for dependency in job.dependencies
+            if isinstance(dependency, _QUERY_DEPENDENCY_TYPES)
+        ]
+        query_results = dict(zip(
+            query_dependencies,
+            self._index.find_many([
+                _dependency_query(dependency) for dependency in query_dependencies
+            ]),
+        ))
+
         resolved_dependencies: List[Dependency] = []
+        remote_refs: Dict[Path, Dict[str, str]] = dict()
 
         for dependency in job.dependencies:
-            resolved_dependency = self.resolve(dependency)
+            resolved_dependency: Union[Job, Dependency, Sequence[Dependency]]
+            if dependency in query_results:
+                resolved_dependency = self._resolve_query_result(
+                    dependency, query_results[dependency]
+                )
+            elif (
+                isinstance(dependency, GitDependency)
+                and not dependency.is_resolved()
+            ):
+                resolved_dependency = self._resolve_git_dependency(
+                    dependency, remote_refs
+                )
+            else:
+                resolved_dependency = self.resolve(dependency)
+
             if isinstance(resolved_dependency, list):
                 resolved_dependencies.extend(resolved_dependency)
             else:
@@ -287,13 +399,31 @@ class Repository:
         job._config["dependencies"] = [  # type: ignore
             dependency.to_config() for dependency in job.dependencies
         ]
+        # The memoized hash depends on the dependencies and is outdated now.
+        job._hash = None
         return job
-    
+
+    def _resolve_query_result(
+        self, dependency: Dependency, result: List[Job]
+    ) -> Union[JobDependency, List[JobDependency]]:
+        if isinstance(dependency, FindLatestDependency):
+            return self._resolve_find_latest_dependency(dependency, result)
+        if isinstance(dependency, FindAllDependency):
+            return self._resolve_find_all_dependency(dependency, result)
+        if isinstance(dependency, QueryDependency):
+            return self._resolve_query_dependency(dependency, result)
+        if isinstance(dependency, QueryAllDependency):
+            return self._resolve_query_all_dependency(dependency, result)
+
+        raise ValueError(f"Cannot resolve {dependency}")
+
     def _resolve_find_latest_dependency(
         self,
         dependency: FindLatestDependency,
+        result: Optional[List[Job]] = None,
     ) -> JobDependency:
-        result = self.find(dependency.query, latest=True)
+        if result is None:
+            result = self.find(dependency.query, latest=True)
 
         if len(result) < 1:
             raise ValueError(f"Cannot resolve dependency: {dependency.query}")
@@ -306,9 +436,12 @@ class Repository:
         )
 
     def _resolve_find_all_dependency(
-        self, dependency: FindAllDependency
+        self,
+        dependency: FindAllDependency,
+        result: Optional[List[Job]] = None,
     ) -> List[JobDependency]:
-        result = self.find(dependency.query)
+        if result is None:
+            result = self.find(dependency.query)
 
         if len(result) < 1:
             raise ValueError(f"Cannot resolve dependency: {dependency.query}")
@@ -325,15 +458,10 @@ class Repository:
     def _resolve_query_dependency(
         self,
         dependency: QueryDependency,
+        result: Optional[List[Job]] = None,
     ) -> JobDependency:
-        tags = dependency.query.strip().split(" ")
-
-        if not all(tag.startswith("#") for tag in tags):
-            raise ValueError(f"Invalid query: {dependency.query}")
-
-        tags = [tag[1:] for tag in tags]
-        query = { "tags": { "$all": tags } }
-        result = self.find(query, latest=True)
+        if result is None:
+            result = self.find(_tags_query(dependency.query), latest=True)
 
         if len(result) < 1:
             raise ValueError(f"Cannot resolve dependency: {dependency.query}")
@@ -345,15 +473,10 @@ class Repository:
     def _resolve_query_all_dependency(
         self,
         dependency: QueryAllDependency,
+        result: Optional[List[Job]] = None,
     ) -> List[JobDependency]:
-        tags = dependency.query_all.strip().split(" ")
-
-        if not all(tag.startswith("#") for tag in tags):
-            raise ValueError(f"Invalid query: {dependency.query_all}")
-
-        tags = [tag[1:] for tag in tags]
-        query = { "tags": { "$all": tags } }
-        result = self.find(query)
+        if result is None:
+            result = self.find(_tags_query(dependency.query_all))
 
         if len(result) < 1:
             raise ValueError(f"Cannot resolve dependency: {dependency.query_all}")
@@ -367,23 +490,35 @@ class Repository:
 
         return resolved_dependencies
 
-    def _resolve_git_dependency(self, dependency: GitDependency) -> GitDependency:
+    def _resolve_git_dependency(
+        self,
+        dependency: GitDependency,
+        remote_refs: Optional[Dict[Path, Dict[str, str]]] = None,
+    ) -> GitDependency:
         repository_path = self.path / dependency.repository_path
         if not repository_path.exists():
             execute(f"git clone --bare {dependency.repository} {repository_path}")
-        
+
+        # The refs of each remote are listed once per job, since jobs often depend on
+        # several branches or tags of the same repository.
+        if remote_refs is None:
+            remote_refs = dict()
+        if repository_path not in remote_refs:
+            remote_refs[repository_path] = r3.utils.git_get_remote_refs(repository_path)
+        refs = remote_refs[repository_path]
+
         if dependency.branch is not None:
-            commit = r3.utils.git_get_remote_branch_head(
-                repository_path, dependency.branch
-            )
+            commit = refs.get(f"refs/heads/{dependency.branch}")
             if commit is None:
                 raise ValueError(f"Branch not found: {dependency.branch}")
         elif dependency.tag is not None:
-            commit = r3.utils.git_get_remote_tag_head(repository_path, dependency.tag)
+            commit = refs.get(f"refs/tags/{dependency.tag}")
             if commit is None:
                 raise ValueError(f"Tag not found: {dependency.tag}")
         else:
-            commit = r3.utils.git_get_remote_head(repository_path)
+            commit = refs.get("HEAD")
+            if commit is None:
+                raise ValueError(f"Remote HEAD not found: {dependency.repository}")
         
         return GitDependency(
             dependency.destination,
@@ -391,3 +526,36 @@ class Repository:
             commit,
             source=dependency.source,
         )
+
+
+# Dependencies that are resolved by querying the index.
+_QUERY_DEPENDENCY_TYPES = (
+    FindLatestDependency,
+    FindAllDependency,
+    QueryDependency,
+    QueryAllDependency,
+)
+
+
+def _dependency_query(dependency: Dependency) -> Tuple[Dict[str, Any], bool]:
+    """Returns the query document and `latest` flag for a query dependency."""
+    if isinstance(dependency, FindLatestDependency):
+        return dependency.query, True
+    if isinstance(dependency, FindAllDependency):
+        return dependency.query, False
+    if isinstance(dependency, QueryDependency):
+        return _tags_query(dependency.query), True
+    if isinstance(dependency, QueryAllDependency):
+        return _tags_query(dependency.query_all), False
+
+    raise ValueError(f"Not a query dependency: {dependency}")
+
+
+def _tags_query(query: str) -> Dict[str, Any]:
+    """Converts a tag query like `#model #mnist` to a query document."""
+    tags = query.strip().split(" ")
+
+    if not all(tag.startswith("#") for tag in tags):
+        raise ValueError(f"Invalid query: {query}")
+
+    return {"tags": {"$all": [tag[1:] for tag in tags]}}
@@ -1,5 +1,7 @@
 """Storage component for R3 repositories."""
 
+import concurrent.futures
+import functools
 import os
 import shutil
 import stat
@@ -8,22 +10,27 @@ import uuid
 import warnings
 from datetime import datetime
 from pathlib import Path
-from typing import Any, Dict, Iterator, Optional, Union
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple, Union
 
-import yaml
 from executor import execute
 
+import r3.utils
 from r3.job import Dependency, GitDependency, Job, JobDependency
 
 
 class Storage:
-    def __init__(self, root: Union[str, os.PathLike]) -> None:
+    def __init__(
+        self, root: Union[str, os.PathLike], parallel_io: bool = True
+    ) -> None:
         """Initializes a storage.
 
         Parameters:
             root: The root directory of the storage (the repository root).
+            parallel_io: Whether to copy files using multiple threads when adding or
+                checking out jobs.
         """
         self.root = Path(root).resolve()
+        self.parallel_io = parallel_io
 
         if not self.root.exists():
             raise FileNotFoundError(f"Root directory does not exist: {self.root}")
@@ -44,6 +51,7 @@ class Storage:
         root = Path(root)
         os.makedirs(root / "git")
         os.makedirs(root / "jobs")
+        os.makedirs(root / "objects")
         return Storage(root)
 
     def __contains__(self, job_or_job_id: Union[Job, str]) -> bool:
@@ -66,6 +74,8 @@ class Storage:
         job_id: str,
         cached_timestamp: Optional[datetime] = None,
         cached_metadata: Optional[Dict[str, Any]] = None,
+        cached_hash: Optional[str] = None,
+        cached_config: Optional[Dict[str, Any]] = None,
     ) -> Job:
         """Retrieves a job from the storage.
         
@@ -75,6 +85,9 @@ class Storage:
                 cache.
             cached_metadata: The metadata of the job to retrieve, if available in the
                 cache.
+            cached_hash: The hash of the job to retrieve, if available in the cache.
+            cached_config: The config of the job to retrieve, if available in the
+                cache.
         
         Returns:
             The job with the given ID.
@@ -87,15 +100,22 @@ class Storage:
             job_id,
             cached_timestamp=cached_timestamp,
             cached_metadata=cached_metadata,
+            cached_hash=cached_hash,
+            cached_config=cached_config,
         )
 
     def jobs(self) -> Iterator[Job]:
         """Returns an iterator over all jobs in the storage."""
-        for path in (self.root / "jobs").iterdir():
-            if path.is_dir():
-                yield Job(path, path.name)
-
-    def add(self, job: Job) -> Job:
+        # `os.scandir` provides the file type without additional system calls in most
+        # cases and avoids creating `Path` objects for entries that are skipped.
+        with os.scandir(self.root / "jobs") as entries:
+            for entry in entries:
+                if entry.is_dir():
+                    yield Job(Path(entry.path), entry.name)
+
+    def add(
+        self, job: Job, file_hash_cache: Optional[r3.utils.FileHashCache] = None
+    ) -> Job:
         """Adds a job to the storage.
         
         This method does not check whether all dependencies of the job are satisfied but
@@ -103,6 +123,9 @@ class Storage:
 
         Parameters:
             job: The job to add to the storage.
+            file_hash_cache: Cache of file hashes to use. If given, the caller is
+                responsible for saving the cache. Otherwise, the cache of this storage
+                is loaded and saved by this method.
         
         Returns:
             The job with updated path and ID.
@@ -114,7 +137,13 @@ class Storage:
             raise FileExistsError(f"Congrats, you found a UUID collision: {job_id}")
 
         job.timestamp = datetime.now()
-        job.hash(recompute=True)
+
+        if file_hash_cache is None:
+            file_hash_cache = self.file_hash_cache()
+            job.hash(recompute=True, file_hash_cache=file_hash_cache)
+            file_hash_cache.save()
+        else:
+            job.hash(recompute=True, file_hash_cache=file_hash_cache)
 
         for dependency in job.dependencies:
             if isinstance(dependency, GitDependency):
@@ -129,26 +158,45 @@ class Storage:
 
         with open(job_path / "r3.yaml", "w") as config_file:
             # REVIEW: Any way to avoid using the private attribute?
-            yaml.dump(job._config, config_file)
+            r3.utils.dump_yaml(job._config, config_file)
         _remove_write_permissions(job_path / "r3.yaml")
 
         with open(job_path / "metadata.yaml", "w") as metadata_file:
-            yaml.dump(job.metadata, metadata_file)
-
-        for destination, source in job.files.items():
-            if destination in [Path("r3.yaml"), Path("metadata.yaml")]:
-                continue
-
-            target = job_path / destination
+            r3.utils.dump_yaml(job.metadata, metadata_file)
+
+        hashes = job._config["hashes"]
+
+        files = [
+            (source, job_path / destination, hashes[str(destination)])
+            for destination, source in job.files.items()
+            if destination not in [Path("r3.yaml"), Path("metadata.yaml")]
+        ]
+
+        for parent in {target.parent for _, target, _ in files}:
+            os.makedirs(parent, exist_ok=True)
+
+        # Files with the same content would race to create the same object when added
+        # in parallel. Hence, one file per hash is added first, which creates all
+        # objects, and the remaining files are linked afterwards.
+        first_files: Dict[str, Tuple[Path, Path, str]] = {}
+        duplicate_files = []
+        for file in files:
+            if file[2] in first_files:
+                duplicate_files.append(file)
+            else:
+                first_files[file[2]] = file
 
-            os.makedirs(target.parent, exist_ok=True)
-            shutil.copy(source, target)
-            _remove_write_permissions(target)
+        self._map(lambda file: self._add_file(*file), list(first_files.values()))
+        self._map(lambda file: self._add_file(*file), duplicate_files)
 
         _remove_write_permissions(job_path)
 
         return Job(job_path, job_id)
 
+    def file_hash_cache(self) -> r3.utils.FileHashCache:
+        """Loads the cache of file hashes of this storage."""
+        return r3.utils.FileHashCache(self.root / "file_hashes.json")
+
     def remove(self, job: Job) -> None:
         """Removes a job from the storage.
 
@@ -160,27 +208,92 @@ class Storage:
         """
         if job not in self:
             raise FileNotFoundError(f"Job not found: {job}")
-    
-        for path in job.files:
-            _add_write_permission(job.path / path)
-        _add_write_permission(job.path)
 
+        hashes = job._config.get("hashes", {})
+        object_paths = [
+            self._object_path(hashes[str(path)])
+            for path in job.files
+            if str(path) in hashes
+        ]
+
+        # Files are hard links to the object store, so changing their permissions would
+        # affect other jobs as well. Removing them only requires write permissions for
+        # the job directory.
+        _add_write_permission(job.path)
         shutil.rmtree(job.path)
 
+        for object_path in object_paths:
+            try:
+                if os.stat(object_path).st_nlink == 1:
+                    os.unlink(object_path)
+            except FileNotFoundError:
+                pass
+
+    def _object_path(self, file_hash: str) -> Path:
+        return self.root / "objects" / file_hash[:2] / file_hash[2:]
+
+    def _add_file(self, source: Path, target: Path, file_hash: str) -> None:
+        # Each distinct file is stored only once in the object store and hard linked
+        # into the job directories. Files are write protected, so the shared content
+        # cannot be changed through any of the links.
+        mode = stat.S_IMODE(os.stat(source).st_mode) & ~_WRITE_PERMISSIONS
+        object_path = self._object_path(file_hash)
+
+        # A single stat both checks whether the object exists and provides its mode. The
+        # mode of a newly created object is known without another stat.
+        try:
+            object_mode = stat.S_IMODE(os.stat(object_path).st_mode)
+        except FileNotFoundError:
+            os.makedirs(object_path.parent, exist_ok=True)
+            temporary_path = object_path.with_name(f"{object_path.name}.{uuid.uuid4()}")
+            _copy_write_protected(source, temporary_path, mode)
+            os.replace(temporary_path, object_path)
+            object_mode = mode
+
+        # Hard links share the file mode, so files that differ only in their mode (e.g.,
+        # the executable bit) cannot be shared. Hard links might also be unsupported by
+        # the file system.
+        if object_mode == mode:
+            try:
+                os.link(object_path, target)
+                return
+            except OSError:
+                pass
+
+        _copy_write_protected(source, target, mode)
+
+    def _map(self, function: Callable[[Any], None], items: List[Any]) -> None:
+        # File operations release the GIL, so using multiple threads hides the latency
+        # of the individual system calls. Exceptions are raised when consuming the
+        # results.
+        if not self.parallel_io or len(items) < 2:
+            for item in items:
+                function(item)
+            return
+
+        with concurrent.futures.ThreadPoolExecutor() as executor:
+            for _ in executor.map(function, items):
+                pass
+
     def checkout(
-        self, item: Union[Job, Dependency], path: Union[str, os.PathLike]
+        self,
+        item: Union[Job, Dependency],
+        path: Union[str, os.PathLike],
+        link: bool = False,
     ) -> None:
         """Checks out a job or dependency to a destination directory.
         
         Parameters:
             item: The job or dependency to check out.
             path: The directory to check out the item to.
+            link: Whether to hard link the files of a job instead of copying them. See
+                `checkout_job` for details.
         """
         if not item.is_resolved():
             raise ValueError(f"Cannot checkout unresolved item: {item}")
 
         if isinstance(item, Job):
-            self.checkout_job(item, path)
+            self.checkout_job(item, path, link=link)
         elif isinstance(item, JobDependency):
             self.checkout_job_dependency(item, path)
         elif isinstance(item, GitDependency):
@@ -190,12 +303,21 @@ class Storage:
                 f"Expected Job, JobDependency or GitDependency, got {type(item)}"
             )
  
-    def checkout_job(self, job: Job, destination: Union[str, os.PathLike]) -> None:
+    def checkout_job(
+        self, job: Job, destination: Union[str, os.PathLike], link: bool = False
+    ) -> None:
         """Checks out a job to a destination directory.
         
         Parameters:
             job: The job to check out.
             destination: The directory to check out the job to.
+            link: Whether to hard link the files of the job instead of copying them.
+                Files that cannot be linked are copied. Linked files share their
+                content with the committed job and with all other jobs that contain
+                the same file. They are write protected, but if the permissions are
+                changed, editing a linked file corrupts the committed jobs. Linked
+                files also keep unused files in the object store from being removed
+                until the checkout is deleted.
         """
         if job not in self:
             raise FileNotFoundError(f"Cannot find job: {job.path}")
@@ -203,12 +325,23 @@ class Storage:
         destination = Path(destination)
         os.makedirs(destination)
 
-        for child in job.path.iterdir():
-            if child.name not in ["r3.yaml", "metadata.yaml", "output"]:
-                if child.is_dir():
-                    shutil.copytree(child, destination / child.name)
-                else:
-                    shutil.copy(child, destination / child.name)
+        with os.scandir(job.path) as entries:
+            children = [
+                entry for entry in entries
+                if entry.name not in ["r3.yaml", "metadata.yaml", "output"]
+            ]
+
+        copy_function = _link_or_copy if link else shutil.copy2
+
+        def checkout_child(entry: os.DirEntry) -> None:
+            if entry.is_dir():
+                shutil.copytree(
+                    entry.path, destination / entry.name, copy_function=copy_function
+                )
+            else:
+                copy_function(entry.path, destination / entry.name)
+
+        self._map(checkout_child, children)
 
         os.symlink(job.path / "output", destination / "output")
 
@@ -240,10 +373,10 @@ class Storage:
             destination: The directory to check out the git dependency to.
         """
         with tempfile.TemporaryDirectory() as tempdir:
-            git_version_str = execute("git --version", capture=True).rsplit(" ", 1)[-1]
-            git_version = tuple(int(part) for part in git_version_str.split("."))
+            git_version = _git_version()
 
             if git_version < (2, 5):
+                git_version_str = ".".join(str(part) for part in git_version)
                 warnings.warn(
                     f"Git is outdated ({git_version_str}). Falling back to cloning the "
                     "entire repository for git dependencies.",
@@ -281,13 +414,41 @@ class Storage:
         return f"Storage({self.root})"
 
 
+@functools.lru_cache(maxsize=None)
+def _git_version() -> Tuple[int, ...]:
+    # The git version does not change while R3 is running, so `git --version` is run
+    # only once instead of for each git dependency that is checked out.
+    git_version_str = execute("git --version", capture=True).rsplit(" ", 1)[-1]
+    return tuple(int(part) for part in git_version_str.split("."))
+
+
+_WRITE_PERMISSIONS = stat.S_IWOTH | stat.S_IWGRP | stat.S_IWUSR
+
+
+def _copy_write_protected(source: Path, target: Path, mode: int) -> None:
+    # Copying the contents only and setting the final mode directly needs a single
+    # chmod per file, compared to two chmods and stats for `shutil.copy` followed by
+    # `_remove_write_permissions`.
+    shutil.copyfile(source, target)
+    os.chmod(target, mode)
+
+
+def _link_or_copy(
+    source: Union[str, os.PathLike], target: Union[str, os.PathLike]
+) -> None:
+    # Hard links might be unsupported by the file system or fail across devices, in
+    # which case the file is copied.
+    try:
+        os.link(source, target)
+    except OSError:
+        shutil.copy2(source, target)
+
+
 def _remove_write_permissions(path: Path) -> None:
     mode = stat.S_IMODE(os.lstat(path).st_mode)
-    mode = mode & ~stat.S_IWOTH & ~stat.S_IWGRP & ~stat.S_IWUSR
-    os.chmod(path, mode)
+    os.chmod(path, mode & ~_WRITE_PERMISSIONS)
 
 
 def _add_write_permission(path: Path) -> None:
     mode = stat.S_IMODE(os.lstat(path).st_mode)
-    mode = mode | stat.S_IWOTH | stat.S_IWGRP | stat.S_IWUSR
-    os.chmod(path, mode)
+    os.chmod(path, mode | _WRITE_PERMISSIONS)
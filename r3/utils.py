@@ -1,58 +1,270 @@
+import functools
 import hashlib
+import json
+import os
+import time
+import uuid
 from pathlib import Path
-from typing import Iterable, List, Optional
+from types import ModuleType
+from typing import (
+    IO,
+    Any,
+    BinaryIO,
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Mapping,
+    Optional,
+    Set,
+    Tuple,
+    Union,
+)
 
 from executor import ExternalCommandFailed, execute
 
 
+@functools.lru_cache(maxsize=None)
+def _yaml() -> Tuple[ModuleType, Any, Any]:
+    # PyYAML is imported on first use. The C implementations of the loader and dumper
+    # are much faster but only available if PyYAML has been built with libyaml.
+    import yaml
+
+    try:
+        from yaml import CDumper as Dumper
+        from yaml import CSafeLoader as SafeLoader
+    except ImportError:
+        from yaml import Dumper, SafeLoader  # type: ignore
+
+    return yaml, SafeLoader, Dumper
+
+
+def load_yaml(stream: Union[str, bytes, IO]) -> Any:
+    """Parses a YAML document using the safe loader."""
+    yaml, loader, _ = _yaml()
+    return yaml.load(stream, Loader=loader)
+
+
+def dump_yaml(data: Any, stream: IO) -> None:
+    """Writes data as YAML document to the given stream."""
+    yaml, _, dumper = _yaml()
+    yaml.dump(data, stream, Dumper=dumper)
+
+
+@functools.lru_cache(maxsize=None)
+def _orjson() -> Optional[ModuleType]:
+    # orjson is an optional dependency that is considerably faster than the standard
+    # library for serializing and parsing JSON.
+    try:
+        import orjson
+    except ImportError:
+        return None
+
+    return orjson
+
+
+def dump_json(data: Any, default: Optional[Callable[[Any], Any]] = None) -> str:
+    """Serializes data as compact JSON string.
+
+    Parameters:
+        data: The data to serialize.
+        default: Optional function that is called for objects that cannot be
+            serialized otherwise and should return a serializable version.
+    """
+    orjson = _orjson()
+
+    if orjson is not None:
+        try:
+            return orjson.dumps(
+                data,
+                default=default,
+                option=orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME,
+            ).decode("utf-8")
+        except TypeError:
+            # orjson is stricter than the standard library, e.g. regarding integers
+            # exceeding 64 bits. These rare cases are handled by the fallback below.
+            pass
+
+    return json.dumps(data, separators=(",", ":"), default=default)
+
+
+def load_json(string: Union[str, bytes]) -> Any:
+    """Parses a JSON document."""
+    orjson = _orjson()
+
+    if orjson is not None:
+        return orjson.loads(string)
+
+    return json.loads(string)
+
+
 def find_files(path: Path, ignore_patterns: Iterable[str]) -> List[Path]:
-    return [child.relative_to(path) for child in _find_files(path, ignore_patterns)]
+    return [Path(file) for file in _find_files(str(path), "", list(ignore_patterns))]
 
 
-def _find_files(path: Path, ignore_patterns: Iterable[str]) -> Iterable[Path]:
+def _find_files(
+    directory: str, prefix: str, ignore_patterns: List[str]
+) -> Iterator[str]:
     if not all(pattern.startswith("/") for pattern in ignore_patterns):
         raise NotImplementedError(
             "Only absolute ignore patterns (starting with /) are supported for now."
         )
 
-    for child in path.iterdir():
-        if _is_ignored(child, ignore_patterns):
-            continue
-
-        if child.is_file():
-            yield child
+    ignored = frozenset(ignore_patterns)
 
-        elif child.is_dir():
-            prefix = f"/{child.name}"
-            ignore_patterns = [
-                pattern[len(prefix) :]
-                for pattern in ignore_patterns
-                if pattern.startswith(prefix)
-            ]
-            yield from _find_files(child, ignore_patterns)
+    # `os.scandir` provides the file type without additional system calls in most cases
+    # and paths are handled as strings, which is much cheaper than using `Path`.
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if f"/{entry.name}" in ignored:
+                continue
 
+            if entry.is_file():
+                yield prefix + entry.name
 
-def _is_ignored(path: Path, ignore_patterns: Iterable[str]):
-    return any(pattern == f"/{path.name}" for pattern in ignore_patterns)
+            elif entry.is_dir():
+                child_prefix = f"/{entry.name}/"
+                child_ignore_patterns = [
+                    pattern[len(child_prefix) - 1 :]
+                    for pattern in ignore_patterns
+                    if pattern.startswith(child_prefix)
+                ]
+                yield from _find_files(
+                    entry.path, f"{prefix}{entry.name}/", child_ignore_patterns
+                )
 
 
 def hash_file(path: Path, chunk_size: int = 2**16) -> str:
+    # Python 3.11+ reads the file into a reusable buffer and hashes it without the
+    # Python-level loop below.
+    if hasattr(hashlib, "file_digest"):
+        with open(path, "rb") as file:
+            _advise_sequential(file)
+            return hashlib.file_digest(file, "sha256").hexdigest()
+
     hash = hashlib.sha256()
+    # Reading into a single buffer avoids allocating a new bytes object per chunk.
+    buffer = memoryview(bytearray(chunk_size))
 
     with open(path, "rb") as file:
+        _advise_sequential(file)
         while True:
-            chunk = file.read(chunk_size)
-            if not chunk:
+            size = file.readinto(buffer)
+            if not size:
                 break
-            hash.update(chunk)
+            hash.update(buffer[:size])
 
     return hash.hexdigest()
 
 
+def _advise_sequential(file: BinaryIO) -> None:
+    # Lets the kernel read ahead more aggressively. This is only a hint, so failures
+    # are ignored.
+    if hasattr(os, "posix_fadvise"):
+        try:
+            os.posix_fadvise(file.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        except OSError:
+            pass
+
+
+class FileHashCache:
+    """Persistent cache of file hashes.
+
+    A cached hash is reused as long as the size, modification time, inode and status
+    change time of the file are unchanged. The status change time cannot be set by
+    user tools, so files rewritten in place with a preserved modification time (e.g.,
+    by `cp -p` or `touch -r`) are hashed again.
+    """
+
+    # Files modified within this interval might be modified again without changing
+    # their modification time, so their hashes are not cached.
+    RACY_INTERVAL_NS = 2 * 10**9
+
+    # Maximum number of cached hashes. When saving, the entries of the files that have
+    # been hashed least recently are dropped first.
+    MAX_ENTRIES = 2**16
+
+    def __init__(self, path: Path) -> None:
+        """Loads the cache.
+
+        Parameters:
+            path: Path to the cache file. The file is created when saving the cache.
+        """
+        self.path = path
+        self._modified = False
+        self._used: Set[str] = set()
+
+        try:
+            with open(path, "rb") as cache_file:
+                self._entries: Dict[str, List[Any]] = load_json(cache_file.read())
+        except (FileNotFoundError, ValueError):
+            self._entries = dict()
+
+    def hash_file(self, path: Path) -> str:
+        """Returns the hash of a file, using the cached hash if it is up to date."""
+        key = str(path)
+        stat = os.stat(path)
+        signature = [stat.st_size, stat.st_mtime_ns, stat.st_ino, stat.st_ctime_ns]
+
+        entry = self._entries.get(key)
+        if entry is not None and entry[:4] == signature:
+            self._used.add(key)
+            return entry[4]
+
+        file_hash = hash_file(path)
+
+        if time.time_ns() - stat.st_mtime_ns > self.RACY_INTERVAL_NS:
+            self._entries[key] = signature + [file_hash]
+            self._used.add(key)
+            self._modified = True
+
+        return file_hash
+
+    def save(self) -> None:
+        """Writes the cache to disk if it has been modified."""
+        if not self._modified and len(self._entries) <= self.MAX_ENTRIES:
+            return
+
+        # Entries are ordered from least to most recently used, so that the oldest
+        # entries are dropped if the cache is full.
+        entries = [
+            (key, entry) for key, entry in self._entries.items()
+            if key not in self._used
+        ]
+        entries.extend((key, self._entries[key]) for key in self._used)
+        self._entries = dict(entries[-self.MAX_ENTRIES:])
+
+        temporary_path = self.path.with_name(f"{self.path.name}.{uuid.uuid4()}")
+        with open(temporary_path, "w") as cache_file:
+            cache_file.write(dump_json(self._entries))
+        os.replace(temporary_path, self.path)
+
+        self._modified = False
+
+
 def hash_str(string: str) -> str:
     return hashlib.sha256(string.encode()).hexdigest()
 
 
+def hash_index(hashes: Mapping[str, str]) -> str:
+    """Hashes a mapping from paths to hashes.
+
+    The result equals the hash of a string containing one line `<path> <hash>` per path
+    in lexicographic order. The lines are fed to the hash function one by one instead of
+    building that string.
+    """
+    hash = hashlib.sha256()
+    separator = b""
+
+    for path in sorted(hashes):
+        hash.update(separator)
+        hash.update(f"{path} {hashes[path]}".encode())
+        separator = b"\n"
+
+    return hash.hexdigest()
+
+
 def git_commit_exists(repository: Path, commit: str) -> bool:
     try:
         object_type = execute(
@@ -81,7 +293,7 @@ def git_path_exists(
     else:
         try:
             execute(
-                f"git ls-tree -r {commit} --name-only | grep '^{path}'",
+                f"git cat-file -e {commit}:{path}",
                 directory=repository,
                 capture=True,
             )
@@ -91,37 +303,19 @@ def git_path_exists(
         return True
 
 
-def git_get_remote_head(repository: Path, remote: str = "origin") -> str:
-    return execute(
-        f"git ls-remote {remote} HEAD",
-        directory=repository,
-        capture=True,
-    ).split()[0]
-
+def git_get_remote_refs(repository: Path, remote: str = "origin") -> Dict[str, str]:
+    """Returns the commits of all refs of a remote, fetched with a single git call.
 
-def git_get_remote_branch_head(
-    repository: Path, branch: str, remote: str = "origin"
-) -> Optional[str]:
-    output = execute(
-        f"git ls-remote --heads {remote} {branch}",
-        directory=repository,
-        capture=True,
-    )
-    if len(output.split()) == 0:
-        return None
-    return output.split()[0]
+    Annotated tags are mapped to the commit they point to rather than the tag object.
+    """
+    output = execute(f"git ls-remote {remote}", directory=repository, capture=True)
 
+    refs: Dict[str, str] = {}
+    for line in output.splitlines():
+        commit, ref = line.split()
+        if ref.endswith("^{}"):
+            refs[ref[:-3]] = commit
+        else:
+            refs.setdefault(ref, commit)
 
-def git_get_remote_tag_head(
-    repository: Path, tag: str, remote: str = "origin"
-) -> Optional[str]:
-    execute(f"git fetch --tags {remote}", directory=repository, capture=True)
-    try:
-        output = execute(
-            f"git rev-list --tags --max-count=1 {tag}",
-            directory=repository,
-            capture=True,
-        )
-    except ExternalCommandFailed:
-        return None
-    return output.split()[0]
+    return refs
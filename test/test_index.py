@@ -2,11 +2,14 @@
 
 import datetime
 from pathlib import Path
-from typing import Any, Dict, List
+from typing import Any, Dict, List, Tuple
 
 import pytest
+from pytest_mock import MockerFixture
 
-from r3.index import Index
+import r3.index
+import r3.utils
+from r3.index import Index, Transaction
 from r3.job import Job, JobDependency
 from r3.storage import Storage
 
@@ -61,6 +64,41 @@ def test_index_defaults_to_empty(storage: Storage):
     assert len(index) == 0
 
 
+def test_index_uses_write_ahead_logging(storage: Storage):
+    index = Index(storage)
+
+    cursor = index.connection.execute("PRAGMA journal_mode")
+    assert cursor.fetchone()[0] == "wal"
+    cursor = index.connection.execute("PRAGMA synchronous")
+    assert cursor.fetchone()[0] == 1  # NORMAL
+
+
+def test_index_reuses_connection(storage: Storage):
+    index = Index(storage)
+    connection = index.connection
+    len(index)
+    assert index.connection is connection
+
+    index.close()
+    assert len(index) == 0
+    assert index.connection is not connection
+
+
+def test_transaction_rolls_back_on_error(storage: Storage):
+    index = Index(storage)
+
+    with pytest.raises(RuntimeError):
+        with Transaction(index.connection) as transaction:
+            transaction.execute(
+                "INSERT INTO jobs (id, timestamp, metadata, hash, config) "
+                "VALUES (?, ?, ?, ?, ?)",
+                ("id", 0, "{}", "hash", "{}"),
+            )
+            raise RuntimeError
+
+    assert len(index) == 0
+
+
 def test_index_add_raises_if_job_not_in_storage(storage: Storage):
     index = Index(storage)
     job = get_dummy_job("base")
@@ -89,6 +127,42 @@ def test_index_rebuild(storage: Storage):
     assert job in index
 
 
+def test_index_rebuild_in_batches(
+    storage_with_jobs: Storage, monkeypatch: pytest.MonkeyPatch
+):
+    monkeypatch.setattr(r3.index, "REBUILD_BATCH_SIZE", 2)
+    index = Index(storage_with_jobs)
+    index.rebuild()
+
+    assert len(index) == 3
+    job = index.find({"tags": "test-again"})[0]
+    assert len(index.find_dependents(job)) == 1
+
+
+def test_index_rebuild_keeps_index_if_rebuilding_fails(
+    storage_with_jobs: Storage, mocker: MockerFixture
+):
+    index = Index(storage_with_jobs)
+    assert len(index) == 3
+
+    mocker.patch.object(storage_with_jobs, "jobs", side_effect=RuntimeError)
+    with pytest.raises(RuntimeError):
+        index.rebuild()
+
+    assert len(index) == 3
+    assert not (storage_with_jobs.root / "index.sqlite.tmp").exists()
+
+
+def test_index_analyze_collects_statistics(storage_with_jobs: Storage):
+    index = Index(storage_with_jobs)
+    index.connection.execute("DELETE FROM sqlite_stat1")
+
+    index.analyze()
+
+    cursor = index.connection.execute("SELECT COUNT(*) FROM sqlite_stat1")
+    assert cursor.fetchone()[0] > 0
+
+
 def test_index_remove(storage_with_jobs: Storage):
     index = Index(storage_with_jobs)
     assert len(index) == 3
@@ -101,6 +175,28 @@ def test_index_remove(storage_with_jobs: Storage):
     assert job not in index
 
 
+def test_index_remove_removes_dependencies(storage_with_jobs: Storage):
+    index = Index(storage_with_jobs)
+    parent_job = index.find({"tags": "test-again"})[0]
+    job = index.find({"tags": "test-latest"})[0]
+    assert len(index.find_dependents(parent_job)) == 1
+
+    index.remove(job)
+
+    cursor = index.connection.execute("SELECT COUNT(*) FROM job_dependencies")
+    assert cursor.fetchone()[0] == 0
+
+
+def test_index_rebuilds_outdated_schema(storage_with_jobs: Storage):
+    index = Index(storage_with_jobs)
+    index.connection.execute("DELETE FROM jobs")
+    index.connection.execute("PRAGMA user_version = 0")
+    index.close()
+
+    index = Index(storage_with_jobs)
+    assert len(index) == 3
+
+
 def test_index_find(storage_with_jobs: Storage):
     index = Index(storage_with_jobs)
 
@@ -167,6 +263,36 @@ def test_index_find_all_tags(
     assert len(results) == expected
 
 
+def test_index_find_many(storage_with_jobs: Storage):
+    index = Index(storage_with_jobs)
+    queries: List[Tuple[Dict[str, Any], bool]] = [
+        ({"tags": "test"}, False),
+        ({"tags": "test"}, True),
+        ({"tags": "does-not-exist"}, False),
+        ({"tags": {"$all": ["test", "test-again"]}}, True),
+    ]
+
+    results = [
+        [job.id for job in result] for result in index.find_many(queries)
+    ]
+    expected = [
+        [job.id for job in index.find(query, latest)] for query, latest in queries
+    ]
+    assert results == expected
+    assert [len(result) for result in results] == [3, 1, 0, 1]
+
+
+def test_index_find_many_in_batches(
+    storage_with_jobs: Storage, monkeypatch: pytest.MonkeyPatch
+):
+    monkeypatch.setattr(r3.index, "FIND_BATCH_SIZE", 2)
+    index = Index(storage_with_jobs)
+    queries = [({"tags": "test"}, latest) for latest in [False, True, False]]
+
+    results = index.find_many(queries)
+    assert [len(result) for result in results] == [3, 1, 3]
+
+
 def test_index_find_latest_returns_only_latest_job(storage_with_jobs: Storage):
     index = Index(storage_with_jobs)
     index.rebuild()
@@ -186,6 +312,19 @@ def test_index_find_uses_cached_timestamp(storage_with_jobs: Storage):
     assert isinstance(job.timestamp, datetime.datetime)
 
 
+def test_index_find_preserves_timestamp(storage: Storage):
+    index = Index(storage)
+    job = get_dummy_job("base")
+    job = storage.add(job)
+    index.add(job)
+
+    timestamp = job.timestamp
+    assert timestamp is not None
+    job = index.find({})[0]
+    assert job.uses_cached_timestamp()
+    assert job.timestamp == timestamp
+
+
 def test_index_find_uses_cached_metadata(storage_with_jobs: Storage):
     index = Index(storage_with_jobs)
     index.rebuild()
@@ -194,6 +333,91 @@ def test_index_find_uses_cached_metadata(storage_with_jobs: Storage):
     assert job.uses_cached_metadata()
 
 
+@pytest.mark.parametrize("use_orjson", [True, False])
+def test_index_find_roundtrips_metadata(
+    storage: Storage, monkeypatch: pytest.MonkeyPatch, use_orjson: bool
+):
+    if not use_orjson:
+        monkeypatch.setattr(r3.utils, "_orjson", lambda: None)
+
+    metadata = {"tags": ["test"], "nested": {"1": 2.5, "none": None}, "text": "\u00e4"}
+    job = get_dummy_job("base")
+    job.metadata.update(metadata)
+    metadata = dict(job.metadata)
+
+    index = Index(storage)
+    index.add(storage.add(job))
+
+    job = index.find({"tags": "test"})[0]
+    assert job.uses_cached_metadata()
+    assert job.metadata == metadata
+
+
+def test_index_find_shares_parsed_configs(
+    storage_with_jobs: Storage, mocker: MockerFixture
+):
+    index = Index(storage_with_jobs)
+    load_json = mocker.spy(r3.utils, "load_json")
+
+    job = index.find({"tags": "test-latest"})[0]
+    other_job = index.find({"tags": "test-latest"})[0]
+    assert other_job is not job
+    assert other_job._config == job._config
+    # Metadata and config are parsed for the first result, only metadata afterwards.
+    assert load_json.call_count == 3
+
+
+def test_index_find_returns_current_metadata(storage_with_jobs: Storage):
+    index = Index(storage_with_jobs)
+
+    job = index.find({"tags": "test-again"})[0]
+    job.metadata["tags"].append("unsaved")
+    assert "unsaved" not in index.find({"tags": "test-again"})[0].metadata["tags"]
+
+    # Metadata changed by another process.
+    metadata = dict(job.metadata, tags=["test", "new"])
+    with index.connection:
+        index.connection.execute(
+            "UPDATE jobs SET metadata = ? WHERE id = ?",
+            (r3.utils.dump_json(metadata), job.id),
+        )
+
+    job = index.find({"tags": "new"})[0]
+    assert job.metadata["tags"] == ["test", "new"]
+
+
+def test_index_config_cache_is_bounded(
+    storage_with_jobs: Storage, monkeypatch: pytest.MonkeyPatch
+):
+    monkeypatch.setattr(r3.index, "CONFIG_CACHE_SIZE", 2)
+    index = Index(storage_with_jobs)
+
+    jobs = index.find({})
+    assert len(jobs) == 3
+    assert len(index._config_cache) == 2
+
+
+def test_index_find_uses_cached_hash(storage_with_jobs: Storage):
+    index = Index(storage_with_jobs)
+
+    for job in index.find({}):
+        assert job._hash is not None
+        assert job.id is not None
+        assert job.hash() == storage_with_jobs.get(job.id).hash()
+
+
+def test_index_find_uses_cached_config(
+    storage_with_jobs: Storage, mocker: MockerFixture
+):
+    index = Index(storage_with_jobs)
+    job = index.find({"tags": "test-latest"})[0]
+
+    load_config = mocker.patch("r3.job._load_config")
+    assert len(job.dependencies) == 1
+    assert job.hash() is not None
+    load_config.assert_not_called()
+
+
 def test_index_find_dependents(storage_with_jobs: Storage):
     index = Index(storage_with_jobs)
 
@@ -226,3 +450,54 @@ def test_index_find_dependents_uses_cached_metadata(storage_with_jobs: Storage):
     job = index.find({"tags": {"$all": ["test-again"]}}, latest=True)[0]
     dependents = index.find_dependents(job)
     assert all(dependent.uses_cached_metadata() for dependent in dependents)
+
+
+def test_index_find_dependents_uses_covering_index(storage: Storage):
+    index = Index(storage)
+
+    cursor = index.connection.execute(
+        "EXPLAIN QUERY PLAN SELECT child_id FROM job_dependencies WHERE parent_id = ?",
+        ("some-id",),
+    )
+    plan = " ".join(str(row) for row in cursor.fetchall())
+
+    assert "COVERING INDEX job_dependencies_parent_id_child_id" in plan
+
+
+def test_index_find_latest_uses_timestamp_index(storage: Storage):
+    index = Index(storage)
+
+    cursor = index.connection.execute(
+        "EXPLAIN QUERY PLAN SELECT id FROM jobs ORDER BY timestamp DESC LIMIT 1"
+    )
+    plan = " ".join(str(row) for row in cursor.fetchall())
+
+    assert "jobs_timestamp" in plan
+
+
+def test_index_find_dependents_recursive(storage: Storage):
+    index = Index(storage)
+
+    def add_job(*parents: Job) -> Job:
+        job = get_dummy_job("base")
+        job._config["dependencies"] = [
+            JobDependency(f"parent{i}", parent).to_config()
+            for i, parent in enumerate(parents)
+        ]
+        job = storage.add(job)
+        index.add(job)
+        return job
+
+    job_a = add_job()
+    job_b = add_job(job_a)
+    job_c = add_job(job_a, job_b)
+    job_d = add_job(job_c)
+
+    dependents = index.find_dependents(job_a)
+    assert {dependent.id for dependent in dependents} == {job_b.id, job_c.id}
+
+    dependents = index.find_dependents(job_a, recursive=True)
+    assert {dependent.id for dependent in dependents} == {job_b.id, job_c.id, job_d.id}
+
+    dependents = index.find_dependents(job_d, recursive=True)
+    assert len(dependents) == 0
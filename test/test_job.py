@@ -1,6 +1,8 @@
 """Unit tests for ``r3.Job``."""
 
 import datetime
+import hashlib
+import os
 import uuid
 from pathlib import Path
 
@@ -36,6 +38,18 @@ def test_job_metadata_returns_empty_dict_when_metadata_yaml_does_not_exist():
     assert job.metadata == {}
 
 
+def test_job_metadata_returns_empty_dict_when_metadata_yaml_is_empty(
+    fs: FakeFilesystem,
+) -> None:
+    job_path = DATA_PATH / "jobs" / "base"
+
+    fs.add_real_directory(job_path, read_only=False)
+    (job_path / "metadata.yaml").write_text("")
+
+    job = r3.Job(job_path)
+    assert job.metadata == {}
+
+
 def test_job_save_metadata_updates_metadata_yaml(fs: FakeFilesystem) -> None:
     job_path = DATA_PATH / "jobs" / "base"
 
@@ -108,6 +122,49 @@ def test_job_datetime_returns_datetime_from_metadata_if_id_is_not_none() -> None
     assert job.timestamp == datetime.datetime(2024, 2, 11, 23, 29, 10)
 
 
+def test_job_files_respects_ignore_patterns(fs: FakeFilesystem) -> None:
+    """Unit test for ``r3.Job.files``."""
+    fs.create_file("/job/r3.yaml", contents="ignore: [/a/x, /b, /output]\n")
+    for file in ["a/x/1.txt", "a/y/2.txt", "b/3.txt", "c/4.txt", "out/5.txt"]:
+        fs.create_file(f"/job/{file}")
+
+    job = r3.Job("/job")
+
+    assert set(job.files.keys()) == {
+        Path("r3.yaml"), Path("a/y/2.txt"), Path("c/4.txt"), Path("out/5.txt")
+    }
+    assert job.files[Path("a/y/2.txt")] == Path("/job/a/y/2.txt")
+
+
+def test_job_files_does_not_modify_config(fs: FakeFilesystem) -> None:
+    fs.create_file(
+        "/job/r3.yaml",
+        contents="ignore: [/output]\ndependencies:\n"
+        "  - {job: 123abc, destination: data}\n",
+    )
+
+    job = r3.Job("/job")
+    assert len(job.files) == 1
+    assert job._config["ignore"] == ["/output"]
+
+
+def test_job_config_is_shared_between_instances(fs: FakeFilesystem) -> None:
+    fs.create_file("/job/r3.yaml", contents="ignore: [/output]\n")
+    os.utime("/job/r3.yaml", ns=(0, 0))
+
+    job = r3.Job("/job")
+    job._config["ignore"] = ["/changed"]
+    other_job = r3.Job("/job")
+    assert other_job._config == {"ignore": ["/output"], "dependencies": []}
+
+    with open("/job/r3.yaml", "w") as config_file:
+        config_file.write("ignore: [/output, /data]\n")
+    os.utime("/job/r3.yaml", ns=(0, 0))
+
+    job = r3.Job("/job")
+    assert job._config["ignore"] == ["/output", "/data"]
+
+
 def test_job_hash_does_not_depend_on_metadata(fs: FakeFilesystem) -> None:
     """Unit test for ``r3.Job.hash()``."""
     job_path = DATA_PATH / "jobs" / "base"
@@ -124,6 +181,58 @@ def test_job_hash_does_not_depend_on_metadata(fs: FakeFilesystem) -> None:
     assert r3.Job(job_path).hash() == original_hash
 
 
+def test_job_hash_uses_stored_hash_for_committed_jobs(fs: FakeFilesystem) -> None:
+    """Unit test for ``r3.Job.hash()``."""
+    job_path = DATA_PATH / "jobs" / "base"
+    fs.add_real_directory(job_path, read_only=False)
+
+    job = r3.Job(job_path)
+    computed_hash = job.hash()
+
+    with open(job_path / "r3.yaml", "w") as config_file:
+        yaml.dump({"hashes": {".": "stored-hash"}}, config_file)
+
+    assert r3.Job(job_path, id=str(uuid.uuid4())).hash() == "stored-hash"
+    assert r3.Job(job_path).hash() == computed_hash
+
+    job = r3.Job(job_path, id=str(uuid.uuid4()))
+    assert job.hash(recompute=True) == computed_hash
+
+
+def test_job_hash_hashes_files(fs: FakeFilesystem) -> None:
+    """Unit test for ``r3.Job.hash()``."""
+    job_path = DATA_PATH / "jobs" / "base"
+    fs.add_real_directory(job_path, read_only=False)
+    fs.create_file(job_path / "data" / "a.txt", contents="a")
+    fs.create_file(job_path / "data" / "b.txt", contents="b")
+
+    job = r3.Job(job_path)
+    expected_hashes = {
+        str(destination): hashlib.sha256(source.read_bytes()).hexdigest()
+        for destination, source in job.files.items()
+        if destination not in (Path("r3.yaml"), Path("metadata.yaml"))
+    }
+    assert len(expected_hashes) == 3
+
+    index = "\n".join(
+        f"{path} {expected_hashes[path]}" for path in sorted(expected_hashes)
+    )
+    assert job.hash() == hashlib.sha256(index.encode()).hexdigest()
+
+
+def test_job_hash_does_not_depend_on_hashlib_version(
+    fs: FakeFilesystem, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    """Unit test for ``r3.Job.hash()``."""
+    job_path = DATA_PATH / "jobs" / "base"
+    fs.add_real_directory(job_path, read_only=False)
+    fs.create_file(job_path / "data.bin", contents=bytes(range(256)) * 1000)
+    expected_hash = r3.Job(job_path).hash()
+
+    monkeypatch.delattr(hashlib, "file_digest", raising=False)
+    assert r3.Job(job_path).hash() == expected_hash
+
+
 def test_depedency_from_config() -> None:
     config = {
         "job": str(uuid.uuid4()),
@@ -567,3 +676,17 @@ def test_git_dependency_is_resolved_if_commit_is_not_none() -> None:
         "https://github.com/user/model.git",
     )
     assert not dependency.is_resolved()
+
+
+def test_git_dependency_repository_path() -> None:
+    for repository in [
+        "https://github.com/user/model.git",
+        "https://github.com/user/model",
+        "git@github.com:user/model.git",
+    ]:
+        dependency = r3.GitDependency(Path("model"), repository)
+        assert dependency.repository_path == Path("git/github.com/user/model")
+
+    dependency = r3.GitDependency(Path("model"), "https://example.com/model.git")
+    with pytest.raises(ValueError):
+        _ = dependency.repository_path
@@ -3,8 +3,19 @@ import sqlite3
 from typing import Any, Dict, Set
 
 import pytest
+from pytest_mock import MockerFixture
 
-from r3.query import Condition, mongo_to_sql
+from r3.query import (
+    AndQuery,
+    Condition,
+    Eq,
+    FieldQuery,
+    NorQuery,
+    NotQuery,
+    OrQuery,
+    Query,
+    mongo_to_sql,
+)
 
 
 @pytest.fixture
@@ -203,6 +214,10 @@ QUERY_TEST_CASES = [
         {"tags": {"$all": ["mnist", 28]}},
         {"mnist-cnn-28", "mnist-resnet-28"},
     ),
+    (
+        {"tags": {"$all": ["mnist", 28, "mnist"]}},
+        {"mnist-cnn-28", "mnist-resnet-28"},
+    ),
     (
         {"tags": {"$all": ["mnist", 1]}},
         set(),
@@ -221,44 +236,146 @@ def test_mongo_to_sql(database: str, query: Dict[str, Any], ids: Set[str]):
     connection = sqlite3.connect(database)
     cursor = connection.cursor()
 
-    cursor.execute(f"SELECT id FROM jobs WHERE {mongo_to_sql(query)}")
+    condition, parameters = mongo_to_sql(query)
+    cursor.execute(f"SELECT id FROM jobs WHERE {condition}", parameters)
     results = set(result[0] for result in cursor.fetchall())
 
     assert results == ids
 
 
 CONDITION_TEST_CASES = [
-    ("mnist",                        "field = 'mnist'"),
-    ({"$eq": "mnist"},               "field = 'mnist'"),
-    ({"$ne": "mnist"},               "field != 'mnist'"),
-    ({"$in": ["mnist", "cifar10"]},  "field IN ('mnist', 'cifar10')"),
-    ({"$nin": ["mnist", "cifar10"]}, "field NOT IN ('mnist', 'cifar10')"),
-    (28 ,                            "field = 28"),
-    ({"$eq": 28},                    "field = 28"),
-    ({"$gt": 28},                    "field > 28"),
-    ({"$gte": 28},                   "field >= 28"),
-    ({"$lt": 28},                    "field < 28"),
-    ({"$lte": 28},                   "field <= 28"),
-    ({"$ne": 28},                    "field != 28"),
-    ({"$in": [28, 32]},              "field IN (28, 32)"),
-    ({"$nin": [28, 32]},             "field NOT IN (28, 32)"),
-    ({"$glob": "resnet/*"},          "field GLOB 'resnet/*'"),
+    ("mnist",                        ("field = ?", ["mnist"])),
+    ({"$eq": "mnist"},               ("field = ?", ["mnist"])),
+    ({"$ne": "mnist"},               ("field != ?", ["mnist"])),
+    ({"$in": ["mnist", "cifar10"]},  ("field IN (?, ?)", ["mnist", "cifar10"])),
+    ({"$nin": ["mnist", "cifar10"]}, ("field NOT IN (?, ?)", ["mnist", "cifar10"])),
+    (28 ,                            ("field = ?", [28])),
+    ({"$eq": 28},                    ("field = ?", [28])),
+    ({"$gt": 28},                    ("field > ?", [28])),
+    ({"$gte": 28},                   ("field >= ?", [28])),
+    ({"$lt": 28},                    ("field < ?", [28])),
+    ({"$lte": 28},                   ("field <= ?", [28])),
+    ({"$ne": 28},                    ("field != ?", [28])),
+    ({"$in": [28, 32]},              ("field IN (?, ?)", [28, 32])),
+    ({"$nin": [28, 32]},             ("field NOT IN (?, ?)", [28, 32])),
+    ({"$glob": "resnet/*"},          ("field GLOB ?", ["resnet/*"])),
     (
         {"$all": ["new", "mnist"]},
-        "EXISTS (SELECT 1 FROM json_each(field) WHERE value = 'new') AND "
-        "EXISTS (SELECT 1 FROM json_each(field) WHERE value = 'mnist')",
+        (
+            "(SELECT COUNT(DISTINCT value) FROM json_each(field) "
+            "WHERE value IN (?, ?)) = 2",
+            ["new", "mnist"],
+        ),
     ),
     (
         {"$all": ["new", 1]},
-        "EXISTS (SELECT 1 FROM json_each(field) WHERE value = 'new') AND "
-        "EXISTS (SELECT 1 FROM json_each(field) WHERE value = 1)",
+        (
+            "(SELECT COUNT(DISTINCT value) FROM json_each(field) "
+            "WHERE value IN (?, ?)) = 2",
+            ["new", 1],
+        ),
     ),
     (
         {"$elemMatch": {"$gt": 28, "$lt": 32}},
-        "EXISTS (SELECT 1 FROM json_each(field) WHERE value > 28 AND value < 32)",
+        (
+            "EXISTS (SELECT 1 FROM json_each(field) WHERE value > ? AND value < ?)",
+            [28, 32],
+        ),
     ),
 ]
 @pytest.mark.parametrize("mongo,sql", CONDITION_TEST_CASES)
 def test_condition_to_sql(mongo, sql):
     condition = Condition.from_mongo(mongo)
     assert condition.to_sql("field") == sql
+
+
+def test_mongo_to_sql_binds_values(database: str):
+    connection = sqlite3.connect(database)
+    cursor = connection.cursor()
+
+    condition, parameters = mongo_to_sql({"dataset": "mnist' OR 'a' = 'a"})
+    assert "mnist" not in condition
+    cursor.execute(f"SELECT id FROM jobs WHERE {condition}", parameters)
+    assert cursor.fetchall() == []
+
+
+def test_mongo_to_sql_escapes_field_names(database: str):
+    connection = sqlite3.connect(database)
+    cursor = connection.cursor()
+
+    condition, parameters = mongo_to_sql({"data'set": "mnist"})
+    cursor.execute(f"SELECT id FROM jobs WHERE {condition}", parameters)
+    assert cursor.fetchall() == []
+
+
+def test_mongo_to_sql_caches_conversions(mocker: MockerFixture):
+    query = {"tags": {"$all": ["mnist", 28]}, "model": {"$in": ["cnn"]}}
+    expected = mongo_to_sql(query)
+
+    from_mongo = mocker.spy(Query, "from_mongo")
+    condition, parameters = mongo_to_sql(query)
+    assert (condition, parameters) == expected
+    from_mongo.assert_not_called()
+
+    # The returned parameters may be modified by the caller.
+    parameters.append("changed")
+    assert mongo_to_sql(query) == expected
+
+
+def test_mongo_to_sql_distinguishes_value_types():
+    assert type(mongo_to_sql({"value": 1})[1][0]) is int
+    assert type(mongo_to_sql({"value": True})[1][0]) is bool
+    assert type(mongo_to_sql({"value": 1.0})[1][0]) is float
+
+
+def test_mongo_to_sql_handles_unhashable_values(
+    database: str, mocker: MockerFixture
+):
+    connection = sqlite3.connect(database)
+    cursor = connection.cursor()
+
+    # Byte arrays are unhashable but bound as blobs, which never equal text values.
+    query = {"model": {"$in": ["cnn", bytearray(b"resnet")]}}
+    from_mongo = mocker.spy(Query, "from_mongo")
+
+    for _ in range(2):
+        condition, parameters = mongo_to_sql(query)
+        cursor.execute(f"SELECT id FROM jobs WHERE {condition}", parameters)
+        results = set(result[0] for result in cursor.fetchall())
+        assert results == {
+            "mnist-cnn-16", "mnist-cnn-28", "mnist-cnn-32",
+            "cifar10-cnn-16", "cifar10-cnn-28", "cifar10-cnn-32",
+        }
+
+    # Queries with unhashable values are not cached.
+    assert from_mongo.call_count == 2
+
+
+SIMPLIFY_TEST_CASES = [
+    (
+        {"$and": [{"$and": [{"a": 1}, {"b": 2}]}, {"c": 3}]},
+        AndQuery([
+            FieldQuery("a", Eq(1)), FieldQuery("b", Eq(2)), FieldQuery("c", Eq(3))
+        ]),
+    ),
+    (
+        {"$or": [{"a": 1}, {"$or": [{"b": 2}, {"c": 3}]}]},
+        OrQuery([
+            FieldQuery("a", Eq(1)), FieldQuery("b", Eq(2)), FieldQuery("c", Eq(3))
+        ]),
+    ),
+    ({"$and": [{"a": 1}]}, FieldQuery("a", Eq(1))),
+    ({"$not": {"$not": {"a": 1}}}, FieldQuery("a", Eq(1))),
+    (
+        {"$not": {"$or": [{"a": 1}, {"b": 2}]}},
+        NorQuery([FieldQuery("a", Eq(1)), FieldQuery("b", Eq(2))]),
+    ),
+    ({"$nor": [{"a": 1}]}, NotQuery(FieldQuery("a", Eq(1)))),
+    (
+        {"$and": [{"$and": []}, {"a": 1}]},
+        AndQuery([AndQuery([]), FieldQuery("a", Eq(1))]),
+    ),
+]
+@pytest.mark.parametrize("mongo,query", SIMPLIFY_TEST_CASES)
+def test_query_simplify(mongo: Dict[str, Any], query: Query):
+    assert Query.from_mongo(mongo).simplify() == query
@@ -12,6 +12,7 @@ import yaml
 from executor import execute
 from pytest_mock.plugin import MockerFixture
 
+import r3.utils
 from r3.job import (
     FindAllDependency,
     FindLatestDependency,
@@ -102,6 +103,44 @@ def test_init_creates_config_file_with_version(tmp_path: Path) -> None:
     assert "version" in config
 
 
+def test_repository_close_closes_index_connection(repository: Repository) -> None:
+    repository.commit(get_dummy_job("base"))
+    assert (repository.path / "index.sqlite-wal").exists()
+
+    repository.close()
+
+    assert repository._index._connection is None
+    assert not (repository.path / "index.sqlite-wal").exists()
+    assert len(list(repository.jobs())) == 1
+
+
+def test_repository_context_manager_closes_repository(tmp_path: Path) -> None:
+    Repository.init(tmp_path / "repository").close()
+
+    with Repository(tmp_path / "repository") as repository:
+        repository.commit(get_dummy_job("base"))
+
+    assert repository._index._connection is None
+
+
+def test_repository_analyze_index(repository: Repository) -> None:
+    repository.commit(get_dummy_job("base"))
+    repository._index.connection.execute("DELETE FROM sqlite_stat1")
+
+    repository.analyze_index()
+
+    cursor = repository._index.connection.execute("SELECT COUNT(*) FROM sqlite_stat1")
+    assert cursor.fetchone()[0] > 0
+
+
+def test_repository_passes_parallel_io_to_storage(tmp_path: Path) -> None:
+    Repository.init(tmp_path / "repository").close()
+
+    assert Repository(tmp_path / "repository")._storage.parallel_io
+    repository = Repository(tmp_path / "repository", parallel_io=False)
+    assert not repository._storage.parallel_io
+
+
 def test_repository_jobs_calls_find(
     tmp_path: Path, mocker: MockerFixture,
 ) -> None:
@@ -181,6 +220,42 @@ def test_repository_contains_git_dependency_clones_repository(
     assert not git_clone_called
 
 
+def test_repository_contains_git_dependency_caches_existing_paths(
+    tmp_path: Path, mocker: MockerFixture,
+) -> None:
+    origin_url = "git@github.com:mtangemann/origin.git"
+    origin = ExampleGitRepository(tmp_path / "origin")
+    repository = Repository.init(tmp_path / "r3")
+    dependency = GitDependency(
+        repository=origin_url,
+        commit=origin.head_commit(),
+        destination="destination",
+    )
+    missing_dependency = GitDependency(
+        repository=origin_url,
+        commit=origin.head_commit(),
+        source="does-not-exist.txt",
+        destination="destination",
+    )
+
+    def patched_execute(command, **kwargs):
+        command = command.replace(origin_url, str(origin.path))
+        return execute(command, **kwargs)
+
+    mocker.patch("r3.repository.execute", new=patched_execute)
+    git_path_exists = mocker.spy(r3.utils, "git_path_exists")
+
+    assert dependency in repository
+    assert missing_dependency not in repository
+    call_count = git_path_exists.call_count
+
+    assert dependency in repository
+    assert git_path_exists.call_count == call_count
+
+    assert missing_dependency not in repository
+    assert git_path_exists.call_count > call_count
+
+
 def test_repository_contains_git_dependency_fetches_all_branches(
     tmp_path: Path, mocker: MockerFixture,
 ) -> None:
@@ -274,6 +349,29 @@ def test_repository_contains_git_dependency_checks_whether_source_exists(
     assert dependency not in repository
 
 
+def test_repository_contains_git_dependency_requires_exact_source_path(
+    tmp_path: Path, mocker: MockerFixture,
+) -> None:
+    origin_url = "git@github.com:mtangemann/origin.git"
+    origin = ExampleGitRepository(tmp_path / "origin")
+    repository = Repository.init(tmp_path / "r3")
+    dependency = GitDependency(
+        repository=origin_url,
+        commit=origin.head_commit(),
+        source="test",
+        destination="destination",
+    )
+
+    def patched_execute(command, **kwargs):
+        command = command.replace(origin_url, str(origin.path))
+        return execute(command, **kwargs)
+
+    mocker.patch("r3.repository.execute", new=patched_execute)
+
+    # "test" is a prefix of "test.txt" but does not exist in the repository.
+    assert dependency not in repository
+
+
 def test_repository_contains_query_dependency(tmp_path: Path) -> None:
     repository = Repository.init(tmp_path / "repository")
 
@@ -348,6 +446,38 @@ def test_commit_sets_timestamp(repository: Repository) -> None:
     assert job.timestamp <= datetime.now()
 
 
+def test_commit_many(repository: Repository, mocker: MockerFixture) -> None:
+    save = mocker.spy(r3.utils.FileHashCache, "save")
+
+    first_job = get_dummy_job("base")
+    first_job.metadata["tags"] = ["first"]
+    second_job = get_dummy_job("base")
+    second_job._dependencies = [FindLatestDependency("data", {"tags": "first"})]
+
+    jobs = repository.commit_many([first_job, second_job])
+
+    assert len(jobs) == 2
+    assert all(job in repository for job in jobs)
+    assert isinstance(jobs[1].dependencies[0], JobDependency)
+    assert jobs[1].dependencies[0].job == jobs[0].id
+    save.assert_called_once()
+
+
+def test_commit_accepts_dependencies_missing_from_the_index(
+    repository: Repository,
+) -> None:
+    parent_job = repository.commit(get_dummy_job("base"))
+    repository._index.remove(parent_job)
+    assert parent_job.id is not None
+
+    job = get_dummy_job("base")
+    job._config["dependencies"] = [JobDependency("data", parent_job.id).to_config()]
+    committed_job = repository.commit(job)
+
+    assert committed_job in repository._index
+    assert len(committed_job.dependencies) == 1
+
+
 def test_commit_copies_files_write_protected(repository: Repository) -> None:
     """Unit test for ``r3.Repository.commit``.
 
@@ -725,6 +855,40 @@ def test_resolve_git_dependency_from_tag(tmp_path: Path, mocker: MockerFixture)
         repository.resolve(dependency)
 
 
+def test_resolve_job_lists_remote_refs_once(
+    tmp_path: Path, mocker: MockerFixture
+) -> None:
+    origin_url = "git@github.com:mtangemann/origin.git"
+    origin = ExampleGitRepository(tmp_path / "origin")
+    origin.add_tag("test")
+    tag_commit = origin.head_commit()
+    origin.update()
+
+    repository = Repository.init(tmp_path / "r3")
+
+    def patched_execute(command, **kwargs):
+        command = command.replace(origin_url, str(origin.path))
+        return execute(command, **kwargs)
+
+    mocker.patch("r3.repository.execute", new=patched_execute)
+    git_get_remote_refs = mocker.spy(r3.utils, "git_get_remote_refs")
+
+    job = get_dummy_job("base")
+    job._dependencies = [
+        GitDependency("head", origin_url),
+        GitDependency("tag", origin_url, tag="test"),
+    ]
+
+    resolved_job = repository.resolve(job)
+    assert isinstance(resolved_job, Job)
+    commits = []
+    for dependency in resolved_job.dependencies:
+        assert isinstance(dependency, GitDependency)
+        commits.append(dependency.commit)
+    assert commits == [origin.head_commit(), tag_commit]
+    git_get_remote_refs.assert_called_once()
+
+
 def test_resolve_job(repository: Repository) -> None:
     job = get_dummy_job("base")
     job.metadata["tags"] = ["test"]
@@ -739,3 +903,43 @@ def test_resolve_job(repository: Repository) -> None:
     assert all(dependency.is_resolved() for dependency in resolved_job.dependencies)
     assert isinstance(resolved_job.dependencies[0], JobDependency)
     assert resolved_job.dependencies[0].job == committed_job.id
+
+
+def test_resolve_job_queries_index_once(
+    repository: Repository, mocker: MockerFixture
+) -> None:
+    job = get_dummy_job("base")
+    job.metadata["tags"] = ["test"]
+    first_job = repository.commit(job)
+
+    job = get_dummy_job("base")
+    job.metadata["tags"] = ["test", "latest"]
+    latest_job = repository.commit(job)
+
+    dependencies = [
+        FindLatestDependency("latest", {"tags": "test"}),
+        FindAllDependency("all", {"tags": "test"}),
+        QueryDependency("query", "#latest"),
+    ]
+    job._dependencies = dependencies
+    job._config["dependencies"] = [
+        dependency.to_config() for dependency in dependencies
+    ]
+
+    find_many = mocker.spy(repository._index, "find_many")
+    find = mocker.spy(repository._index, "find")
+    resolved_job = repository.resolve(job)
+
+    assert isinstance(resolved_job, Job)
+    find_many.assert_called_once()
+    find.assert_not_called()
+    resolved_dependencies = []
+    for dependency in resolved_job.dependencies:
+        assert isinstance(dependency, JobDependency)
+        resolved_dependencies.append((str(dependency.destination), dependency.job))
+    assert resolved_dependencies == [
+        ("latest", latest_job.id),
+        (f"all/{first_job.id}", first_job.id),
+        (f"all/{latest_job.id}", latest_job.id),
+        ("query", latest_job.id),
+    ]
@@ -1,7 +1,9 @@
 """Unit tests for `r3.storage`."""
 
 import filecmp
+import json
 import os
+import stat
 import tempfile
 from pathlib import Path
 
@@ -11,6 +13,8 @@ from executor import execute
 from pyfakefs.fake_filesystem import FakeFilesystem
 from pytest_mock import MockerFixture
 
+import r3.storage
+import r3.utils
 from r3.job import GitDependency, Job, JobDependency
 from r3.storage import Storage
 
@@ -40,6 +44,7 @@ def test_storage_init_creates_directories(fs: FakeFilesystem):
     Storage.init("/repository")
     assert Path("/repository/jobs").is_dir()
     assert Path("/repository/git").is_dir()
+    assert Path("/repository/objects").is_dir()
 
 
 def test_storage_add_updates_job_path(fs: FakeFilesystem):
@@ -94,6 +99,31 @@ def test_storage_add_copies_source_files(fs: FakeFilesystem):
         )
 
 
+@pytest.mark.parametrize("parallel_io", [True, False])
+def test_storage_add_and_checkout_nested_source_files(
+    fs: FakeFilesystem, parallel_io: bool
+):
+    fs.create_dir("/repository")
+    storage = Storage.init("/repository")
+    storage.parallel_io = parallel_io
+
+    source_files = ["run.py", "model/__init__.py", "model/layers/conv.py"]
+    fs.create_file("/job/r3.yaml", contents="dependencies: []\n")
+    for source_file in source_files:
+        fs.create_file(f"/job/{source_file}", contents=source_file)
+
+    committed_job = storage.add(Job("/job"))
+
+    for source_file in source_files:
+        assert (committed_job.path / source_file).read_text() == source_file
+
+    checkout_path = Path("/checkout")
+    storage.checkout_job(committed_job, checkout_path)
+
+    for source_file in source_files:
+        assert (checkout_path / source_file).read_text() == source_file
+
+
 def test_storage_add_saves_metadata(fs: FakeFilesystem):
     fs.create_dir("/repository")
     storage = Storage.init("/repository")
@@ -110,6 +140,65 @@ def test_storage_add_saves_metadata(fs: FakeFilesystem):
     assert metadata["test"] == "value"
 
 
+def test_storage_add_write_protects_files_and_preserves_mode(fs: FakeFilesystem):
+    fs.create_dir("/repository")
+    storage = Storage.init("/repository")
+
+    fs.create_file("/job/run.py", contents="print('hello')")
+    fs.create_file("/job/script.sh", contents="echo hello")
+    os.chmod("/job/run.py", 0o644)
+    os.chmod("/job/script.sh", 0o755)
+
+    job = storage.add(Job("/job"))
+
+    assert stat.S_IMODE(os.stat(job.path / "run.py").st_mode) == 0o444
+    assert stat.S_IMODE(os.stat(job.path / "script.sh").st_mode) == 0o555
+
+
+def test_storage_add_deduplicates_files(fs: FakeFilesystem):
+    fs.create_dir("/repository")
+    storage = Storage.init("/repository")
+
+    job = get_dummy_job(fs, "base")
+    job1 = storage.add(job)
+    job2 = storage.add(job)
+
+    stat1 = os.stat(job1.path / "run.py")
+    stat2 = os.stat(job2.path / "run.py")
+    assert stat1.st_ino == stat2.st_ino
+    assert stat1.st_nlink == 3
+
+
+def test_storage_add_deduplicates_files_within_a_job(fs: FakeFilesystem):
+    fs.create_dir("/repository")
+    storage = Storage.init("/repository")
+    fs.create_file("/job/r3.yaml", contents="dependencies: []\n")
+    for index in range(8):
+        fs.create_file(f"/job/copy{index}.py", contents="print('hello')")
+
+    committed_job = storage.add(Job("/job"))
+
+    stats = [os.stat(committed_job.path / f"copy{index}.py") for index in range(8)]
+    assert len({stat.st_ino for stat in stats}) == 1
+    assert stats[0].st_nlink == 9
+
+
+def test_storage_add_does_not_share_files_with_different_modes(fs: FakeFilesystem):
+    fs.create_dir("/repository")
+    storage = Storage.init("/repository")
+
+    fs.create_file("/job1/script.sh", contents="echo hello")
+    fs.create_file("/job2/script.sh", contents="echo hello")
+    os.chmod("/job1/script.sh", 0o644)
+    os.chmod("/job2/script.sh", 0o755)
+
+    job1 = storage.add(Job("/job1"))
+    job2 = storage.add(Job("/job2"))
+
+    assert stat.S_IMODE(os.stat(job1.path / "script.sh").st_mode) == 0o444
+    assert stat.S_IMODE(os.stat(job2.path / "script.sh").st_mode) == 0o555
+
+
 def test_storage_add_saves_hashes(fs: FakeFilesystem):
     fs.create_dir("/repository")
     storage = Storage.init("/repository")
@@ -123,6 +212,84 @@ def test_storage_add_saves_hashes(fs: FakeFilesystem):
     assert "hashes" in config
 
 
+def test_storage_add_caches_file_hashes(fs: FakeFilesystem, mocker: MockerFixture):
+    fs.create_dir("/repository")
+    storage = Storage.init("/repository")
+
+    job = get_dummy_job(fs, "base")
+    committed_job = storage.add(job)
+    assert (storage.root / "file_hashes.json").is_file()
+
+    hash_file = mocker.patch("r3.utils.hash_file")
+    recommitted_job = storage.add(Job(job.path))
+    hash_file.assert_not_called()
+    assert recommitted_job.hash() == committed_job.hash()
+
+
+def test_storage_add_keeps_file_hashes_of_other_jobs(
+    fs: FakeFilesystem, mocker: MockerFixture
+):
+    fs.create_dir("/repository")
+    storage = Storage.init("/repository")
+
+    job = get_dummy_job(fs, "base")
+    storage.add(job)
+    storage.add(get_dummy_job(fs, "nested"))
+
+    hash_file = mocker.spy(r3.utils, "hash_file")
+    storage.add(Job(job.path))
+    hash_file.assert_not_called()
+
+
+def test_storage_add_bounds_file_hash_cache(
+    fs: FakeFilesystem, monkeypatch: pytest.MonkeyPatch
+):
+    monkeypatch.setattr(r3.utils.FileHashCache, "MAX_ENTRIES", 1)
+    fs.create_dir("/repository")
+    storage = Storage.init("/repository")
+
+    storage.add(get_dummy_job(fs, "base"))
+    other_job = get_dummy_job(fs, "nested")
+    storage.add(other_job)
+
+    with open(storage.root / "file_hashes.json") as cache_file:
+        entries = json.load(cache_file)
+    assert len(entries) == 1
+    assert next(iter(entries)).startswith(f"{other_job.path}/")
+
+
+def test_storage_add_rehashes_files_rewritten_with_preserved_mtime(
+    fs: FakeFilesystem,
+):
+    fs.create_dir("/repository")
+    storage = Storage.init("/repository")
+    fs.create_file("/job/run.py", contents="print('hello')")
+    os.utime("/job/run.py", ns=(0, 0))
+
+    committed_job = storage.add(Job("/job"))
+
+    with open("/job/run.py", "w") as source_file:
+        source_file.write("print('world')")
+    os.utime("/job/run.py", ns=(0, 0))
+
+    recommitted_job = storage.add(Job("/job"))
+    assert recommitted_job.hash() != committed_job.hash()
+
+
+def test_storage_add_does_not_cache_hashes_of_recently_modified_files(
+    fs: FakeFilesystem, mocker: MockerFixture
+):
+    fs.create_dir("/repository")
+    storage = Storage.init("/repository")
+    fs.create_file("/job/run.py", contents="print('hello')")
+
+    storage.add(Job("/job"))
+
+    hash_file = mocker.spy(r3.utils, "hash_file")
+    storage.add(Job("/job"))
+    hash_file.assert_called_once()
+
+
 def test_storage_contains(fs: FakeFilesystem):
     fs.create_dir("/repository")
     storage = Storage.init("/repository")
@@ -214,6 +381,26 @@ def test_storage_remove_deletes_job_folder(fs: FakeFilesystem):
     assert not job.path.exists()
 
 
+def test_storage_remove_deletes_unused_objects(fs: FakeFilesystem):
+    fs.create_dir("/repository")
+    storage = Storage.init("/repository")
+
+    job = get_dummy_job(fs, "base")
+    job1 = storage.add(job)
+    job2 = storage.add(job)
+
+    file_hash = job1._config["hashes"]["run.py"]
+    object_path = storage.root / "objects" / file_hash[:2] / file_hash[2:]
+    assert object_path.is_file()
+
+    storage.remove(job1)
+    assert object_path.is_file()
+    assert (job2.path / "run.py").is_file()
+
+    storage.remove(job2)
+    assert not object_path.exists()
+
+
 def test_storage_remove_raises_if_job_does_not_exist(fs: FakeFilesystem):
     fs.create_dir("/repository")
     storage = Storage.init("/repository")
@@ -231,7 +418,7 @@ def test_checkout_delegates_to_specific_checkout_method(fs: FakeFilesystem):
     committed_job = storage.add(original_job)
 
     checkout_job_called = False
-    def _checkout_job(item, path):
+    def _checkout_job(item, path, link=False):
         nonlocal checkout_job_called
         checkout_job_called = True
     storage.checkout_job = _checkout_job  # type: ignore
@@ -280,6 +467,57 @@ def test_checkout_job_copies_source_files(fs: FakeFilesystem):
         )
 
 
+def test_checkout_job_does_not_link_source_files_by_default(fs: FakeFilesystem):
+    fs.create_dir("/repository")
+    storage = Storage.init("/repository")
+
+    original_job = get_dummy_job(fs, "base")
+    committed_job = storage.add(original_job)
+
+    checkout_path = Path("/checkout")
+    storage.checkout_job(committed_job, checkout_path)
+
+    committed_stat = os.stat(committed_job.path / "run.py")
+    checkout_stat = os.stat(checkout_path / "run.py")
+    assert checkout_stat.st_ino != committed_stat.st_ino
+    assert committed_stat.st_nlink == 2
+
+
+def test_checkout_job_hard_links_source_files(fs: FakeFilesystem):
+    fs.create_dir("/repository")
+    storage = Storage.init("/repository")
+
+    original_job = get_dummy_job(fs, "base")
+    committed_job = storage.add(original_job)
+
+    checkout_path = Path("/checkout")
+    storage.checkout_job(committed_job, checkout_path, link=True)
+
+    committed_stat = os.stat(committed_job.path / "run.py")
+    checkout_stat = os.stat(checkout_path / "run.py")
+    assert checkout_stat.st_ino == committed_stat.st_ino
+
+
+def test_checkout_job_copies_source_files_if_hard_links_fail(
+    fs: FakeFilesystem, mocker: MockerFixture
+):
+    fs.create_dir("/repository")
+    storage = Storage.init("/repository")
+
+    original_job = get_dummy_job(fs, "base")
+    committed_job = storage.add(original_job)
+
+    mocker.patch("r3.storage.os.link", side_effect=OSError)
+
+    checkout_path = Path("/checkout")
+    storage.checkout_job(committed_job, checkout_path, link=True)
+
+    committed_stat = os.stat(committed_job.path / "run.py")
+    checkout_stat = os.stat(checkout_path / "run.py")
+    assert checkout_stat.st_ino != committed_stat.st_ino
+    assert filecmp.cmp(committed_job.path / "run.py", checkout_path / "run.py")
+
+
 def test_checkout_job_symlinks_output_files(fs: FakeFilesystem):
     fs.create_dir("/repository")
     storage = Storage.init("/repository")
@@ -448,3 +686,30 @@ def test_checkout_git_dependency_clones_repository():
             expected_content_path / "test" / "test_storage.py",
             checkout_path / "destination",
         )
+
+
+def test_checkout_git_dependency_runs_git_version_once(mocker: MockerFixture):
+    with tempfile.TemporaryDirectory() as tempdir:
+        storage = Storage.init(f"{tempdir}/repository")
+        r3.storage._git_version.cache_clear()
+
+        git_version_calls = []
+
+        def patched_execute(command: str, **kwargs):
+            if command == "git --version":
+                git_version_calls.append(command)
+                return "git version 2.39.2"
+        mocker.patch("r3.storage.execute", new=patched_execute)
+        mocker.patch("r3.storage.shutil.move")
+
+        dependency = GitDependency(
+            repository="https://github.com/mtangemann/r3.git",
+            commit="c2397aac3fbdca682150faf721098b6f5a47806b",
+            destination="destination",
+        )
+
+        storage.checkout_git_dependency(dependency, Path(tempdir))
+        storage.checkout_git_dependency(dependency, Path(tempdir))
+        # Do not leak the patched version to other tests.
+        r3.storage._git_version.cache_clear()
+        assert len(git_version_calls) == 1